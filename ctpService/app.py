@@ -6,6 +6,11 @@ from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.options import options
 
+from gateway.constant import TopicMode
+from gateway.instrument import instrument_registry
+from gateway.session import session_manager
+from gateway.settlement import settlement_cache
+from handlers.consumer import tick_feed
 from logger import logger
 from settings import settings, db_config
 from urls import url_patterns
@@ -15,6 +20,19 @@ class CtpApplication(web.Application):
     def __init__(self):
         super(CtpApplication, self).__init__(url_patterns, **settings)
         db.setup(db_config, minconn=2, maxconn=5)
+        if options.topic_mode in TopicMode.accept_type:
+            session_manager.topic_mode = getattr(TopicMode, options.topic_mode.upper())
+        else:
+            logger.warning('unknown topic_mode %s, use resume', options.topic_mode)
+        session_manager.ticks = tick_feed
+        session_manager.account_options = {
+            'interval': options.estimate_interval,
+            'query_interval': options.account_query_interval,
+            'commission_rate': options.commission_rate,
+        }
+        instrument_registry.query_source = session_manager.instrument_query
+        instrument_registry.start()
+        settlement_cache.load()
 
 
 def main():
@@ -7,6 +7,19 @@ class Direction(object):
     SHORT = '1'      # sell
 
 
+class PosiDirection(object):
+    # 持仓多空方向常量
+    NET = '1'        # 净
+    LONG = '2'       # 多头
+    SHORT = '3'      # 空头
+
+
+class PositionDate(object):
+    # 持仓日期常量
+    TODAY = '1'      # 今日持仓
+    HISTORY = '2'    # 历史持仓
+
+
 class Offset(object):
     # 开平常量
     OPEN = '0'              # 开仓
@@ -33,3 +46,29 @@ class OrderType(object):
     COVER = u'cover'     # 买平
 
     accept_type = ['buy', 'sell', 'short', 'cover']
+
+
+class OrderStatus(object):
+    # 报单状态常量
+    ALL_TRADED = '0'                    # 全部成交
+    PART_TRADED_QUEUEING = '1'          # 部分成交还在队列中
+    PART_TRADED_NOT_QUEUEING = '2'      # 部分成交不在队列中
+    NO_TRADE_QUEUEING = '3'             # 未成交还在队列中
+    NO_TRADE_NOT_QUEUEING = '4'         # 未成交不在队列中
+    CANCELED = '5'                      # 撤单
+    UNKNOWN = 'a'                       # 未知（已提交柜台，交易所尚未确认）
+    NOT_TOUCHED = 'b'                   # 尚未触发
+    TOUCHED = 'c'                       # 已触发
+    PENDING = 'pending'                 # 本地已发出，尚无回报
+    REJECTED = 'rejected'               # 柜台或交易所拒单
+
+    finished = [ALL_TRADED, PART_TRADED_NOT_QUEUEING, NO_TRADE_NOT_QUEUEING, CANCELED, REJECTED]
+
+
+class TopicMode(object):
+    # 私有流、公共流的订阅方式
+    RESTART = 0     # 从本交易日开始重传
+    RESUME = 1      # 从上次收到的位置续传
+    QUICK = 2       # 只传登录后的数据
+
+    accept_type = ['restart', 'resume', 'quick']
@@ -0,0 +1,245 @@
+# -*- coding:utf-8 -*-
+
+import logging
+import time
+from datetime import datetime, timedelta
+
+from tornado import gen
+
+from constant import Direction, Offset, OrderStatus, PosiDirection
+from instrument import instrument_registry
+from registry import CtpError
+from stream import DeltaStream
+
+
+def contract_size(symbol):
+    instrument = instrument_registry.get(symbol)
+    return instrument.volume_multiple if instrument is not None else 1
+
+
+def margin_ratio(symbol, direction):
+    """
+    合约表中交易所的保证金率，按金额计；柜台加收的部分在下一次资金查询时校正。
+    当天合约表里没有保证金率（旧快照）或为无效值（如DBL_MAX）时返回0，保证金估算不变
+    """
+    instrument = instrument_registry.get(symbol)
+    if instrument is None:
+        return 0
+    ratio = instrument.data.get('LongMarginRatio' if direction == Direction.LONG else 'ShortMarginRatio') or 0
+    return ratio if 0 < ratio < 1 else 0
+
+
+class MarkedPosition(object):
+    """锚定之后一个合约方向的持仓，value为按参考价计的市值，参考价未知时为None"""
+
+    __slots__ = ('volume', 'value')
+
+    def __init__(self, volume, value=None):
+        self.volume = volume
+        self.value = value
+
+
+class AccountEstimator(object):
+    """
+    资金账户的本地估算，只在IOLoop线程中使用
+
+    以最近一次资金查询为锚，两次查询之间用成交回报估算平仓盈亏、手续费和保证金，用报单回报估算冻结保证金，
+    用最新行情估算持仓盈亏；每interval秒推送一次估算值（只推送变化的字段），每query_interval秒用真实查询重新锚定。
+    没有订阅者时停止查询和行情订阅。
+    """
+
+    def __init__(self, query, positions, ticks=None, interval=1, query_interval=30, commission_rate=0.0001):
+        self.query = query  # 返回Future的资金查询函数，结果为AccountEvent
+        self.positions = positions  # PositionLedger，锚定时的持仓
+        self.ticks = ticks  # 行情源，subscribe(symbol, callback)返回日期 / unsubscribe(symbol, callback, date)，回调参数为Tick
+        self.interval = interval  # 推送周期（秒）
+        self.query_interval = query_interval  # 真实查询周期（秒）
+        self.commission_rate = commission_rate  # 按成交金额估算手续费的费率
+        self.stream = DeltaStream(self.snapshot)
+        self.anchor = None  # 最近一次查询结果的data
+        self.anchor_time = 0
+        self.marked = {}  # (InstrumentID, PosiDirection) -> MarkedPosition
+        self.prices = {}  # InstrumentID -> 最新价
+        self.watching = {}  # 已订阅行情的合约 -> 订阅的日期
+        self.frozen = {}  # 未结束的开仓报单，order_key -> 冻结保证金
+        self.anchor_frozen = 0  # 锚定时已冻结的保证金，已包含在查询结果中
+        self.close_profit = 0  # 锚定之后的平仓盈亏
+        self.commission = 0  # 锚定之后的手续费
+        self.margin = 0  # 锚定之后的保证金变化
+        self.last = None  # 最近一次推送的估算值
+        self.running = False
+
+    def snapshot(self):
+        return self.last
+
+    def subscribe(self):
+        """
+        :return: tornado.queues.Queue，元素为StreamEvent，data为资金的全部字段或变化的字段
+        """
+        queue = self.stream.subscribe()
+        if not self.running:
+            self.running = True
+            self.run()
+        return queue
+
+    def unsubscribe(self, queue):
+        self.stream.unsubscribe(queue)
+
+    @gen.coroutine
+    def run(self):
+        positions = self.positions.subscribe()
+        try:
+            while self.stream:
+                if time.time() - self.anchor_time >= self.query_interval:
+                    yield self.reanchor(positions)
+                if self.anchor is not None:
+                    self.publish()
+                yield gen.sleep(self.interval)
+        finally:
+            self.positions.unsubscribe(positions)
+            self.running = False
+            self.anchor = None
+            self.anchor_time = 0
+            self.last = None
+            self.watch(set())
+
+    @gen.coroutine
+    def reanchor(self, positions):
+        """查询资金，以查询结果和当前持仓为新的起点"""
+        while not self.positions.loaded:
+            # 等持仓账本完成第一次查询
+            try:
+                yield positions.get(timeout=timedelta(seconds=self.query_interval))
+            except gen.TimeoutError:
+                return
+        try:
+            account = yield self.query()
+        except CtpError as exp:
+            logging.warning('account query failed: %s', exp)
+            return
+        while positions.qsize():
+            positions.get_nowait()
+        if account is None:
+            return
+        self.anchor = account.data
+        self.anchor_time = time.time()
+        self.anchor_frozen = sum(self.frozen.itervalues())
+        self.close_profit = self.commission = self.margin = 0
+        self.marked = {}
+        for key, position in self.positions.positions.iteritems():
+            if position.position:
+                self.marked[key] = MarkedPosition(position.position)
+                self.mark(key)
+        self.watch(set(symbol for symbol, _ in self.marked))
+
+    def mark(self, key):
+        """参考价取最新价，之后的持仓盈亏按相对参考价的变化估算"""
+        marked = self.marked[key]
+        price = self.prices.get(key[0])
+        if marked.value is None and price is not None:
+            marked.value = price * marked.volume * contract_size(key[0])
+
+    def watch(self, symbols):
+        """订阅symbols的行情，退订其余合约；日期变化后按新日期重新订阅"""
+        if self.ticks is None:
+            return
+        today = datetime.now().strftime('%Y%m%d')
+        for symbol, date in self.watching.items():
+            if symbol not in symbols or date != today:
+                self.ticks.unsubscribe(symbol, self.on_tick, date)
+                del self.watching[symbol]
+                if symbol not in symbols:
+                    self.prices.pop(symbol, None)
+        for symbol in symbols:
+            if symbol not in self.watching:
+                self.watching[symbol] = self.ticks.subscribe(symbol, self.on_tick)
+
+    def on_tick(self, tick):
+        try:
+            symbol, price = tick.symbol, tick.data['LastPrice']
+        except (ValueError, KeyError, TypeError) as exp:
+            logging.warning('bad tick %s: %s', tick.body, exp)
+            return
+        self.prices[symbol] = price
+        for direction in (PosiDirection.LONG, PosiDirection.SHORT):
+            if (symbol, direction) in self.marked:
+                self.mark((symbol, direction))
+
+    def on_trade(self, event):
+        """onRtnTrade，在持仓账本之前调用"""
+        if self.anchor is None or event.price is None:
+            return
+        size = contract_size(event.symbol)
+        amount = event.price * event.volume * size
+        self.commission += amount * self.commission_rate
+        if event.offset == Offset.OPEN:
+            direction = PosiDirection.LONG if event.direction == Direction.LONG else PosiDirection.SHORT
+            key = (event.symbol, direction)
+            marked = self.marked.get(key)
+            if marked is None:
+                marked = self.marked[key] = MarkedPosition(0, 0)
+                self.watch(set(self.watching) | {event.symbol})
+            marked.volume += event.volume
+            if marked.value is not None:
+                marked.value += amount
+            self.margin += amount * margin_ratio(event.symbol, event.direction)
+        else:
+            direction = PosiDirection.SHORT if event.direction == Direction.LONG else PosiDirection.LONG
+            key = (event.symbol, direction)
+            marked = self.marked.get(key)
+            if marked is None or marked.volume <= 0:
+                return
+            volume = min(event.volume, marked.volume)
+            if marked.value is not None:
+                part = marked.value * volume / marked.volume
+                sign = 1 if direction == PosiDirection.LONG else -1
+                self.close_profit += sign * (event.price * volume * size - part)
+                marked.value -= part
+            marked.volume -= volume
+            held = Direction.LONG if direction == PosiDirection.LONG else Direction.SHORT
+            self.margin -= event.price * volume * size * margin_ratio(event.symbol, held)
+
+    def on_order(self, event):
+        """onRtnOrder，未成交的开仓报单冻结保证金"""
+        if event.offset != Offset.OPEN:
+            return
+        if event.status in OrderStatus.finished or not event.price:
+            self.frozen.pop(event.key, None)
+        else:
+            self.frozen[event.key] = (event.price * (event.volume - event.traded) * contract_size(event.symbol) *
+                                      margin_ratio(event.symbol, event.direction))
+
+    def position_profit(self):
+        """锚定之后持仓盈亏的变化"""
+        profit = 0
+        for (symbol, direction), marked in self.marked.iteritems():
+            price = self.prices.get(symbol)
+            if marked.value is None or price is None:
+                continue
+            sign = 1 if direction == PosiDirection.LONG else -1
+            profit += sign * (price * marked.volume * contract_size(symbol) - marked.value)
+        return profit
+
+    def estimate(self):
+        account = dict(self.anchor)
+        position_profit = self.position_profit()
+        frozen = sum(self.frozen.itervalues()) - self.anchor_frozen
+        account['closeProfit'] += self.close_profit
+        account['positionProfit'] += position_profit
+        account['commission'] += self.commission
+        account['margin'] += self.margin
+        account['frozenMargin'] += frozen
+        account['balance'] += self.close_profit + position_profit - self.commission
+        account['available'] += (self.close_profit + min(position_profit, 0) - self.commission -
+                                 self.margin - frozen)
+        account['estimated'] = time.time() - self.anchor_time >= self.interval
+        return account
+
+    def publish(self):
+        last, self.last = self.last, self.estimate()
+        if last is None:
+            self.stream.publish_snapshot()
+            return
+        delta = dict((key, value) for key, value in self.last.iteritems() if last.get(key) != value)
+        if delta:
+            self.stream.publish(delta)
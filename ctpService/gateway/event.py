@@ -0,0 +1,117 @@
+# -*- coding:utf-8 -*-
+
+import json
+
+from order_book import order_key
+
+
+class Event(object):
+    """
+    CTP回报事件，在CTP回调线程中创建，经IOLoop交给报单簿和各个请求
+
+    data为回报原始数据，常用字段解析为属性；to_json只在第一次调用时编码，
+    同一条回报推给多个客户端、写入redis时共用同一份JSON。
+    """
+
+    __slots__ = ('data', '_json')
+    msg_type = None
+
+    def __init__(self, data):
+        self.data = data
+        self._json = None
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.data)
+        return self._json
+
+
+class OrderEvent(Event):
+    """onRtnOrder"""
+
+    __slots__ = ('key', 'symbol', 'exchange_id', 'order_sys_id', 'status', 'direction', 'offset', 'price', 'volume',
+                 'traded')
+    msg_type = 'onRtnOrder'
+
+    def __init__(self, data):
+        super(OrderEvent, self).__init__(data)
+        self.key = order_key(data['FrontID'], data['SessionID'], data['OrderRef'])
+        self.symbol = data['InstrumentID']
+        self.exchange_id = data['ExchangeID']
+        self.order_sys_id = str(data['OrderSysID']).strip()
+        self.status = data['OrderStatus']
+        self.direction = data.get('Direction')
+        self.offset = data.get('CombOffsetFlag', '')[:1]
+        self.price = data.get('LimitPrice')
+        self.volume = data['VolumeTotalOriginal']
+        self.traded = data['VolumeTraded']
+
+
+class TradeEvent(Event):
+    """onRtnTrade"""
+
+    __slots__ = ('trade_id', 'symbol', 'exchange_id', 'order_sys_id', 'direction', 'offset', 'price', 'volume')
+    msg_type = 'onRtnTrade'
+
+    def __init__(self, data):
+        super(TradeEvent, self).__init__(data)
+        self.trade_id = str(data['TradeID']).strip()
+        self.symbol = data.get('InstrumentID')
+        self.exchange_id = data['ExchangeID']
+        self.order_sys_id = str(data['OrderSysID']).strip()
+        self.direction = data.get('Direction')
+        self.offset = data.get('OffsetFlag')
+        self.price = data.get('Price')
+        self.volume = data['Volume']
+
+
+class ErrorEvent(Event):
+    """报单、撤单错误：onRspOrderInsert, onErrRtnOrderInsert, onRspOrderAction, onErrRtnOrderAction"""
+
+    __slots__ = ('msg_type', 'order_ref', 'front_id', 'session_id', 'error_id', 'error_msg')
+
+    def __init__(self, msg_type, data):
+        super(ErrorEvent, self).__init__(data)
+        self.msg_type = msg_type
+        self.order_ref = data['OrderRef']
+        self.front_id = data.get('FrontID')
+        self.session_id = data.get('SessionID')
+        self.error_id = data['ErrorID']
+        self.error_msg = data['ErrorMsg']
+
+
+class AccountEvent(Event):
+    """资金账户查询结果"""
+
+    __slots__ = ('account_id', 'balance', 'available')
+    msg_type = 'account'
+
+    def __init__(self, data):
+        super(AccountEvent, self).__init__(data)
+        self.account_id = data['accountID']
+        self.balance = data['balance']
+        self.available = data['available']
+
+
+class PositionEvent(Event):
+    """持仓查询结果，每个合约方向（上期所今昨仓分开）一条"""
+
+    __slots__ = ('symbol', 'direction', 'position')
+    msg_type = 'position'
+
+    def __init__(self, data):
+        super(PositionEvent, self).__init__(data)
+        self.symbol = data['InstrumentID']
+        self.direction = data['PosiDirection']
+        self.position = data['Position']
+
+
+class StreamEvent(Event):
+    """资金、持仓推送：snapshot为全量，delta为变化的字段或行，seq在同一数据流内递增"""
+
+    __slots__ = ('msg_type', 'seq')
+
+    def __init__(self, msg_type, seq, data):
+        super(StreamEvent, self).__init__({'msg_type': msg_type, 'seq': seq, 'data': data})
+        self.msg_type = msg_type
+        self.seq = seq
@@ -1,27 +1,29 @@
 # -*- coding:utf-8 -*-
 
-import json
+import fcntl
+import hashlib
 import logging
 import os
-import random
 import time
 from datetime import datetime
 
-import redis
+from tornado.ioloop import IOLoop
 from vnctptd import TdApi
 
+from constant import TopicMode
+from event import OrderEvent, TradeEvent, ErrorEvent, AccountEvent, PositionEvent
+from settlement import settlement_cache
+
 logging.basicConfig(
     level=logging.DEBUG,
     format='%(threadName)s %(levelname)s || %(asctime)s || %(message)s'
 )
 
-client = redis.Redis(host='localhost', port=6379)
-
 
 class CtpTdApi(TdApi):
     """CTP交易API实现"""
 
-    def __init__(self, user_id, password, broker_id, address, queue=None):
+    def __init__(self, user_id, password, broker_id, address, gateway=None, topic_mode=TopicMode.RESUME):
         """API对象的初始化函数"""
         super(CtpTdApi, self).__init__()
 
@@ -32,6 +34,7 @@ class CtpTdApi(TdApi):
         self.loginStatus = False  # 登录状态
         self.authStatus = False  # 验证状态
         self.loginFailed = False  # 登录失败（账号密码错误）
+        self.ready = False  # 会话就绪（已登录且确认结算单，可以发单）
 
         self.userID = user_id  # 账号
         self.password = password  # 密码
@@ -40,17 +43,33 @@ class CtpTdApi(TdApi):
 
         self.frontID = 0  # 前置机编号
         self.sessionID = 0  # 会话编号
+        self.tradingDay = None  # 交易日
+        self.maxOrderRef = 0  # 本会话已用的最大报单引用
 
-        self.exchange_id = None   # 本次连接委托单交易所ID
-        self.order_sys_id = None  # 本次连接内委托单系统ID
-
-        self.posDict = {}
         self.symbolExchangeDict = {}  # 保存合约代码和交易所的印射关系
+        self.instrumentRows = []  # 合约查询回报，收齐后一次性推送
         self.symbolSizeDict = {}  # 保存合约代码和合约大小的印射关系
 
         self.requireAuthentication = False
+        self.topicMode = topic_mode  # 私有流、公共流的订阅方式
+
+        self.flowLock = None  # 占用流文件目录的锁文件，close时释放
+        self.gateway = gateway  # 接收回报消息的上层对象
+        self.ioloop = IOLoop.current()  # 回报消息投递的IOLoop，需在IOLoop线程中创建API对象
 
-        self.queue = queue    # 回报消息保存队列
+    def push(self, event):
+        """把报单、成交等主动回报从CTP回调线程投递到IOLoop"""
+        self.ioloop.add_callback(self.gateway.on_message, event)
+
+    def respond(self, req_id, event, error, last):
+        """把请求的响应连同请求编号和last标志投递到IOLoop"""
+        if error and error.get('ErrorID'):
+            error = {'ErrorID': error['ErrorID'], 'ErrorMsg': error['ErrorMsg'].decode('gbk').encode('utf-8')}
+        self.ioloop.add_callback(self.gateway.on_response, req_id, event, error, last)
+
+    def push_status(self):
+        """通知上层登录状态发生变化"""
+        self.ioloop.add_callback(self.gateway.on_status)
 
     def connect(self):
         """初始化连接"""
@@ -60,9 +79,9 @@ class CtpTdApi(TdApi):
             path = self.get_temp_path()
             self.createFtdcTraderApi(path)
 
-            # 设置数据同步模式为推送从今日开始所有数据
-            self.subscribePrivateTopic(0)
-            self.subscribePublicTopic(0)
+            # 设置数据同步模式，RESUME时只推送流文件记录的位置之后的数据
+            self.subscribePrivateTopic(self.topicMode)
+            self.subscribePublicTopic(self.topicMode)
 
             # 注册服务器地址
             self.registerFront(self.address)
@@ -110,24 +129,35 @@ class CtpTdApi(TdApi):
         if error['ErrorID'] == 0:
             self.frontID = str(data['FrontID'])
             self.sessionID = str(data['SessionID'])
+            self.tradingDay = data['TradingDay']
+            self.maxOrderRef = int(str(data['MaxOrderRef']).strip() or 0)
             logging.info('onRspUserLogin frontID = %s', self.frontID)
             logging.info('onRspUserLogin sessionID = %s', self.sessionID)
             self.loginStatus = True
 
             logging.info('Trading server login completed.')
-            # 确认结算信息
-            req = {
-                'BrokerID': self.brokerID,
-                'InvestorID': self.userID,
-            }
-            self.reqID += 1
-            self.reqSettlementInfoConfirm(req, self.reqID)
+            if settlement_cache.is_confirmed(self.brokerID, self.userID, self.tradingDay):
+                # 本交易日已确认过结算单，直接就绪
+                self.setReady()
+            elif self.tradingDay > datetime.today().strftime('%Y%m%d'):
+                # 夜盘的交易日是下一个工作日，而ConfirmDate是自然日，查询结果无法判断是否确认过最新的结算单，
+                # 直接确认，和不查询时一样只需一次往返
+                self.confirmSettlement()
+            else:
+                # 不确定是否已确认（可能由其他进程或终端确认），先查询确认状态
+                req = {
+                    'BrokerID': self.brokerID,
+                    'InvestorID': self.userID,
+                }
+                self.reqID += 1
+                self.reqQrySettlementInfoConfirm(req, self.reqID)
             # 否则，推送错误信息
         else:
             msg = 'onRspUserLogin ErrorID: %s, ErrorMsg: %s'
             logging.error(msg, error['ErrorID'], error['ErrorMsg'].decode('gbk'))
             # 标识登录失败，防止用错误信息连续重复登录
             self.loginFailed = True
+            self.push_status()
 
     def authenticate(self):
         """申请验证"""
@@ -153,11 +183,15 @@ class CtpTdApi(TdApi):
     def close(self):
         """关闭"""
         self.exit()
+        if self.flowLock is not None:
+            self.flowLock.close()
+            self.flowLock = None
 
     def onFrontDisconnected(self, n):
         """服务器断开"""
         self.connectionStatus = False
         self.loginStatus = False
+        self.ready = False
         logging.info('Trading server disconnected.')
 
     def onHeartBeatWarning(self, n):
@@ -167,28 +201,62 @@ class CtpTdApi(TdApi):
         """登出回报"""
         if error['ErrorID'] == 0:
             self.loginStatus = False
+            self.ready = False
             logging.info('Trading server logout completed.')
         else:
             msg = 'ErrorID: %s, ErrorMsg: %s'
             logging.error(msg, error['ErrorID'], error['ErrorMsg'].decode('gbk'))
 
+    def confirmSettlement(self):
+        """确认结算信息"""
+        req = {
+            'BrokerID': self.brokerID,
+            'InvestorID': self.userID,
+        }
+        self.reqID += 1
+        self.reqSettlementInfoConfirm(req, self.reqID)
+
+    def onRspQrySettlementInfoConfirm(self, data, error, n, last):
+        """查询结算信息确认回报，只在日盘查询，此时交易日即自然日"""
+        logging.info('onRspQrySettlementInfoConfirm: %s', data)
+        if data and data.get('ConfirmDate') == self.tradingDay:
+            settlement_cache.add(self.brokerID, self.userID, self.tradingDay)
+            self.setReady()
+        else:
+            self.confirmSettlement()
+
     def onRspSettlementInfoConfirm(self, data, error, n, last):
-        """确认结算信息回报"""
-        logging.info('Settlement info confirmed.')
+        """确认结算信息回报，确认成功才记录并就绪"""
         logging.info('onRspSettlementInfoConfirm time: %s', time.time())
         logging.info('onRspSettlementInfoConfirm: %s', data)
-        # 查询合约代码
+        if error and error.get('ErrorID'):
+            msg = 'onRspSettlementInfoConfirm ErrorID: %s, ErrorMsg: %s'
+            logging.error(msg, error['ErrorID'], error['ErrorMsg'].decode('gbk'))
+            self.loginFailed = True
+            self.push_status()
+            return
+        logging.info('Settlement info confirmed.')
+        settlement_cache.add(self.brokerID, self.userID, self.tradingDay)
+        self.setReady()
+
+    def setReady(self):
+        """会话就绪，是否查询合约由上层根据当天的合约表决定"""
+        self.ready = True
+        self.push_status()
+
+    def qryInstrument(self):
+        """查询全部合约"""
         self.reqID += 1
-        self.reqQryInstrument({}, self.reqID)
+        ret = self.reqQryInstrument({}, self.reqID)
+        return self.reqID, ret
 
     def onRspQryInstrument(self, data, error, n, last):
-        """合约查询回报"""
-        symbol = data['InstrumentID']
-        exchange_id = data['ExchangeID']
+        """合约查询回报，合约表经on_instruments推送，请求编号只在last时了结"""
         # logging.info('onRspQryInstrument data: %s', data)
-        client.hset('SymbolExchangeMap', symbol, exchange_id)
-        self.symbolExchangeDict.update({symbol: exchange_id})
-        today_str = datetime.today().strftime('%Y%m%d')
+        if error and error.get('ErrorID'):
+            self.instrumentRows = []
+            self.respond(n, None, error, True)
+            return
         contract = {
             'InstrumentID': data['InstrumentID'],
             'InstrumentName': data['InstrumentName'].decode('gbk').encode('utf-8'),
@@ -203,14 +271,22 @@ class CtpTdApi(TdApi):
             'MaxLimitOrderVolume': data['MaxLimitOrderVolume'],
             'VolumeMultiple': data['VolumeMultiple'],
             'ProductClass': data['ProductClass'],
+            'LongMarginRatio': data['LongMarginRatio'],
+            'ShortMarginRatio': data['ShortMarginRatio'],
         }
-        instrument_info_key = 'Instrument-{}'.format(today_str)
-        client.hset(instrument_info_key, symbol, json.dumps(contract))
+        self.instrumentRows.append(contract)
+        if last:
+            # 全部合约收齐后一次性交给IOLoop，更新合约表并由后台线程写入redis，回调线程不做网络IO
+            rows, self.instrumentRows = self.instrumentRows, []
+            today_str = datetime.today().strftime('%Y%m%d')
+            self.ioloop.add_callback(self.gateway.on_instruments, today_str, rows)
+            self.respond(n, None, error, last)
 
     def qryAccount(self):
-        """查询账户"""
+        """查询账户，返回请求编号和发送结果"""
         self.reqID += 1
-        self.reqQryTradingAccount({}, self.reqID)
+        ret = self.reqQryTradingAccount({}, self.reqID)
+        return self.reqID, ret
 
     def onRspQryTradingAccount(self, data, error, n, last):
         """资金账户查询回报"""
@@ -226,16 +302,13 @@ class CtpTdApi(TdApi):
             'available': data['Available'],
             'commission': data['Commission'],
             'margin': data['CurrMargin'],
+            'frozenMargin': data['FrozenMargin'],
             'closeProfit': data['CloseProfit'],
             'positionProfit': data['PositionProfit'],
             'balance': balance,
         }
         logging.info('onRspQryTradingAccount data: %s', account)
-        data = {
-            'msg_type': 'account',
-            'data': account,
-        }
-        self.queue.put(json.dumps(data))
+        self.respond(n, AccountEvent(account), error, last)
         # account = VtAccountData()
         # account.gatewayName = self.gatewayName
         #
@@ -267,71 +340,24 @@ class CtpTdApi(TdApi):
             'BrokerID': self.brokerID,
             'InvestorID': self.userID
         }
-        self.reqQryInvestorPosition(req, self.reqID)
+        ret = self.reqQryInvestorPosition(req, self.reqID)
+        return self.reqID, ret
+
+    def qryOrder(self):
+        """查询当日全部报单"""
+        self.reqID += 1
+        req = {
+            'BrokerID': self.brokerID,
+            'InvestorID': self.userID
+        }
+        ret = self.reqQryOrder(req, self.reqID)
+        return self.reqID, ret
 
     def onRspQryInvestorPosition(self, data, error, n, last):
-        """持仓查询回报"""
+        """持仓查询回报，上期所今昨仓分两条返回，由持仓账本按合约方向合并"""
         logging.info('onRspQryInvestorPosition time: %s', time.time())
         logging.info('onRspQryInvestorPosition data: %s', data)
-        msg = {
-            'msg_type': 'position',
-            'data': data
-        }
-        self.queue.put(json.dumps(msg))
-
-        # if not data['InstrumentID']:
-        #     return
-        #
-        # # 获取持仓缓存对象
-        # posName = '.'.join([data['InstrumentID'], data['PosiDirection']])
-        # if posName in self.posDict:
-        #     pos = self.posDict[posName]
-        # else:
-        #     pos = VtPositionData()
-        #     self.posDict[posName] = pos
-        #
-        #     pos.gatewayName = self.gatewayName
-        #     pos.symbol = data['InstrumentID']
-        #     pos.vtSymbol = pos.symbol
-        #     pos.direction = posiDirectionMapReverse.get(data['PosiDirection'], '')
-        #     pos.vtPositionName = '.'.join([pos.vtSymbol, pos.direction])
-        #
-        # exchange = self.symbolExchangeDict.get(pos.symbol, EXCHANGE_UNKNOWN)
-        #
-        # # 针对上期所持仓的今昨分条返回（有昨仓、无今仓），读取昨仓数据
-        # if exchange == EXCHANGE_SHFE:
-        #     if data['YdPosition'] and not data['TodayPosition']:
-        #         pos.ydPosition = data['Position']
-        # # 否则基于总持仓和今持仓来计算昨仓数据
-        # else:
-        #     pos.ydPosition = data['Position'] - data['TodayPosition']
-        #
-        # # 计算成本
-        # size = self.symbolSizeDict[pos.symbol]
-        # cost = pos.price * pos.position * size
-
-        # 汇总总仓
-        # pos.position += data['Position']
-        # pos.positionProfit += data['PositionProfit']
-        #
-        # # 计算持仓均价
-        # if pos.position and size:
-        #     pos.price = (cost + data['PositionCost']) / (pos.position * size)
-        #
-        # # 读取冻结
-        # if pos.direction is DIRECTION_LONG:
-        #     pos.frozen += data['LongFrozen']
-        # else:
-        #     pos.frozen += data['ShortFrozen']
-        #
-        # # 查询回报结束
-        # if last:
-        #     # 遍历推送
-        #     for pos in self.posDict.values():
-        #         self.gateway.onPosition(pos)
-        #
-        #     # 清空缓存
-        #     self.posDict.clear()
+        self.respond(n, PositionEvent(data), error, last)
 
     def sendOrder(self, order):
         """
@@ -339,13 +365,14 @@ class CtpTdApi(TdApi):
         :return:
         """
         self.reqID += 1
-        self.reqOrderInsert(order, self.reqID)
+        ret = self.reqOrderInsert(order, self.reqID)
         order['RequestID'] = self.reqID
         order['FrontID'] = self.frontID
         order['SessionID'] = self.sessionID
         logging.info('sendOrder time: %s', time.time())
         logging.info('sendOrder data: %s', order)
         logging.info('=' * 30)
+        return self.reqID, ret
 
     def onRspOrderInsert(self, data, error, n, last):
         """发单错误（柜台）"""
@@ -355,11 +382,9 @@ class CtpTdApi(TdApi):
         data['ErrorID'] = error['ErrorID']
         data['ErrorMsg'] = error['ErrorMsg'].decode('gbk').encode('utf-8')
         data['callback'] = 'onRspOrderInsert'
-        msg = {
-            'msg_type': 'onRspOrderInsert',
-            'data': data,
-        }
-        self.queue.put(json.dumps(msg))
+        # 报单录入请求中没有前置和会话编号时补上本会话的以便定位报单，柜台已给出的不覆盖
+        self.fillSession(data)
+        self.push(ErrorEvent('onRspOrderInsert', data))
         # 推送委托信息
         # order = VtOrderData()
         # order.gatewayName = self.gatewayName
@@ -382,6 +407,13 @@ class CtpTdApi(TdApi):
         # err.errorMsg = error['ErrorMsg'].decode('gbk')
         # self.gateway.onError(err)
 
+    def fillSession(self, data):
+        """回报中没有前置和会话编号（缺失或为0）时填入本会话的"""
+        if not data.get('FrontID'):
+            data['FrontID'] = self.frontID
+        if not data.get('SessionID'):
+            data['SessionID'] = self.sessionID
+
     def onErrRtnOrderInsert(self, data, error):
         """发单错误回报（交易所）"""
         logging.info('onErrRtnOrderInsert time: %s', time.time())
@@ -390,11 +422,9 @@ class CtpTdApi(TdApi):
         data['ErrorID'] = error['ErrorID']
         data['ErrorMsg'] = error['ErrorMsg'].decode('gbk').encode('utf-8')
         data['callback'] = 'onErrRtnOrderInsert'
-        msg = {
-            'msg_type': 'onErrRtnOrderInsert',
-            'data': data
-        }
-        self.queue.put(json.dumps(msg))
+        # 私有流会回放其他会话的报单错误，柜台已给出的前置和会话编号不覆盖
+        self.fillSession(data)
+        self.push(ErrorEvent('onErrRtnOrderInsert', data))
 
         # 推送委托信息
         # order = VtOrderData()
@@ -422,16 +452,10 @@ class CtpTdApi(TdApi):
         """报单回报"""
         logging.info('onRtnOrder time: %s', time.time())
         logging.info('onRtnOrder data: %s', data)
-        if str(data['SessionID']) == self.sessionID and str(data['FrontID']) == self.frontID:
-            data['StatusMsg'] = data['StatusMsg'].decode('gbk').encode('utf-8')
-            data['callback'] = 'onRtnOrder'
-            self.exchange_id = str(data['ExchangeID'])
-            self.order_sys_id = str(data['OrderSysID']).strip()
-            msg = {
-                'msg_type': 'onRtnOrder',
-                'data': data,
-            }
-            self.queue.put(json.dumps(msg))
+        # 账户下所有会话的报单都交给报单簿，便于按合约或账户撤单
+        data['StatusMsg'] = data['StatusMsg'].decode('gbk').encode('utf-8')
+        data['callback'] = 'onRtnOrder'
+        self.push(OrderEvent(data))
 
         # 更新最大报单编号
         # newref = data['OrderRef']
@@ -474,15 +498,7 @@ class CtpTdApi(TdApi):
         logging.info('onRtnTrade time: %s', time.time())
         logging.info('onRtnTrade data: %s', data)
         data['callback'] = 'onRtnTrade'
-        logging.info('self.exchange_id = %s', self.exchange_id)
-        logging.info('self.order_sys_id = %s', self.order_sys_id)
-        if data['ExchangeID'] == self.exchange_id and str(data['OrderSysID']).strip() == self.order_sys_id:
-            msg = {
-                'msg_type': 'onRtnTrade',
-                'data': data
-            }
-            self.queue.put(json.dumps(msg))
-            logging.info('put onRtnTrade data into queue!')
+        self.push(TradeEvent(data))
 
         # 创建报单数据对象
         # trade = VtTradeData()
@@ -517,7 +533,8 @@ class CtpTdApi(TdApi):
         """撤单"""
         self.reqID += 1
         logging.info('cancelOrder data: %s', order)
-        self.reqOrderAction(order, self.reqID)
+        ret = self.reqOrderAction(order, self.reqID)
+        return self.reqID, ret
 
         # req = dict()
         # req['InstrumentID'] = cancelOrderReq.symbol
@@ -539,11 +556,7 @@ class CtpTdApi(TdApi):
         data['ErrorID'] = error['ErrorID']
         data['ErrorMsg'] = error['ErrorMsg'].decode('gbk').encode('utf-8')
         data['callback'] = 'onRspOrderAction'
-        msg = {
-            'msg_type': 'onRspOrderAction',
-            'data': data,
-        }
-        self.queue.put(json.dumps(msg))
+        self.push(ErrorEvent('onRspOrderAction', data))
         # err = VtErrorData()
         # err.gatewayName = self.gatewayName
         # err.errorID = error['ErrorID']
@@ -557,11 +570,7 @@ class CtpTdApi(TdApi):
         data['ErrorID'] = error['ErrorID']
         data['ErrorMsg'] = error['ErrorMsg'].decode('gbk').encode('utf-8')
         data['callback'] = 'onErrRtnOrderAction'
-        msg = {
-            'msg_type': 'onErrRtnOrderAction',
-            'data': data,
-        }
-        self.queue.put(json.dumps(msg))
+        self.push(ErrorEvent('onErrRtnOrderAction', data))
         # err = VtErrorData()
         # err.gatewayName = self.gatewayName
         # err.errorID = error['ErrorID']
@@ -569,9 +578,10 @@ class CtpTdApi(TdApi):
         # self.gateway.onError(err)
 
     def onRspError(self, error, n, last):
-        """错误回报"""
+        """错误回报，请求编号对应的查询立即失败，不用等到超时"""
         logging.info('onRspError time: %s', time.time())
         logging.info('onRspError data: %s', error)
+        self.respond(n, None, error, last)
         # self.order_queue.put(json.dumps(error))
         # err = VtErrorData()
         # err.gatewayName = self.gatewayName
@@ -595,14 +605,28 @@ class CtpTdApi(TdApi):
         """"""
         pass
 
-    @staticmethod
-    def get_temp_path():
-        temp_path = os.path.join(os.getcwd(), 'trade_connect', str(random.randint(0, 99)))
-        if not os.path.exists(temp_path):
-            os.makedirs(temp_path)
-        path = os.path.join(temp_path, 'CTP_')
-
-        return path
+    def get_temp_path(self):
+        """
+        流文件目录：每个账户一组编号目录，每个API实例独占其中第一个空闲的，
+        同一账户同时只有一个实例时总是用到同一个目录，RESUME模式依赖其中记录的接收位置
+        """
+        digest = hashlib.md5(self.address).hexdigest()[:8]
+        name = '{}_{}_{}'.format(self.brokerID, self.userID, digest)
+        slot = 0
+        while True:
+            temp_path = os.path.join(os.getcwd(), 'trade_connect', name, str(slot))
+            if not os.path.exists(temp_path):
+                os.makedirs(temp_path)
+            lock = open(os.path.join(temp_path, '.lock'), 'w')
+            try:
+                # flock按打开的文件加锁，同一进程内的另一个实例也会被挡住
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock.close()
+                slot += 1
+                continue
+            self.flowLock = lock
+            return os.path.join(temp_path, 'CTP_')
 
     def onRspQueryMaxOrderVolume(self, data, error, n, last):
         """"""
@@ -645,8 +669,14 @@ class CtpTdApi(TdApi):
         pass
 
     def onRspQryOrder(self, data, error, n, last):
-        """"""
-        pass
+        """报单查询回报，没有报单时返回一条空数据"""
+        logging.info('onRspQryOrder data: %s', data)
+        event = None
+        if data and str(data.get('OrderRef', '')).strip():
+            data['StatusMsg'] = data['StatusMsg'].decode('gbk').encode('utf-8')
+            data['callback'] = 'onRspQryOrder'
+            event = OrderEvent(data)
+        self.respond(n, event, error, last)
 
     def onRspQryTrade(self, data, error, n, last):
         """"""
@@ -696,10 +726,6 @@ class CtpTdApi(TdApi):
         """"""
         pass
 
-    def onRspQrySettlementInfoConfirm(self, data, error, n, last):
-        """"""
-        pass
-
     def onRspQryInvestorPositionCombineDetail(self, data, error, n, last):
         """"""
         pass
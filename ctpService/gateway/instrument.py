@@ -0,0 +1,205 @@
+# -*- coding:utf-8 -*-
+
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import redis
+from concurrent.futures import ThreadPoolExecutor  # `pip install futures` for python2
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+def instrument_key(day=None):
+    """redis中按日期保存的合约信息hash"""
+    return 'Instrument-{}'.format(day or datetime.today().strftime('%Y%m%d'))
+
+
+def snapshot_path(day):
+    """本地合约快照文件"""
+    return os.path.join(os.getcwd(), 'instrument_snapshot', '{}.json'.format(instrument_key(day)))
+
+
+class Instrument(object):
+    """一个合约的静态信息"""
+
+    __slots__ = ('symbol', 'exchange_id', 'product_id', 'product_class', 'price_tick', 'volume_multiple',
+                 'max_limit_order_volume', 'data')
+
+    def __init__(self, data):
+        self.symbol = data['InstrumentID']
+        self.exchange_id = data['ExchangeID']
+        self.product_id = data['ProductID']
+        self.product_class = data['ProductClass']
+        self.price_tick = data['PriceTick']
+        self.volume_multiple = data['VolumeMultiple']
+        self.max_limit_order_volume = data['MaxLimitOrderVolume']
+        self.data = data
+
+
+class InstrumentRegistry(object):
+    """
+    进程内共享的合约信息表，只在IOLoop线程中读写
+
+    启动时先读本地快照文件，没有时在后台线程从redis加载当天的合约信息。当天还没有合约表时，
+    第一个登录的会话查询合约，结果整体替换合约表，并在后台线程写回redis和本地快照，
+    之后的登录不再查询。会话跨日保持登录时，日期变化后redis中仍没有新一天的合约表，
+    由池中已就绪的会话查询。发单路径只查内存，不再访问redis。
+    """
+
+    def __init__(self, refresh_interval=60, query_timeout=60):
+        self.instruments = {}  # InstrumentID -> Instrument
+        self.day = None  # 当前数据对应的日期
+        self.loading = False
+        self.query_timeout = query_timeout  # 会话查询合约的超时时间（秒），超时后允许其他会话重新查询
+        self.query_time = None  # 正在查询合约的开始时间
+        self.waiting = None  # 加载期间被拒绝的会话的合约查询函数，加载后没有合约表时由它查询
+        self.query_source = None  # 返回一个已就绪会话的合约查询函数，没有时返回None，由SessionManager设置
+        self.redis = redis.Redis(host='localhost', port=6379)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.refresher = PeriodicCallback(self.refresh, refresh_interval * 1000)
+
+    def get(self, symbol):
+        """
+        :return: Instrument，未知合约返回None
+        """
+        return self.instruments.get(symbol)
+
+    def product_symbols(self, product_id):
+        """
+        :return: 品种下的全部合约，按合约代码排序
+        """
+        return sorted(symbol for symbol, instrument in self.instruments.iteritems()
+                      if instrument.product_id == product_id)
+
+    def exchange_id(self, symbol):
+        instrument = self.instruments.get(symbol)
+        return instrument.exchange_id if instrument is not None else None
+
+    def claim(self, query=None):
+        """
+        会话登录后调用，当天还没有合约表且没有其他会话在查询时返回True，由该会话查询合约
+        :param query: 该会话的合约查询函数，正在加载时记下，加载后仍没有当天的合约表时再查询
+        """
+        today = datetime.today().strftime('%Y%m%d')
+        if self.day == today:
+            return False
+        if self.loading:
+            if query is not None:
+                self.waiting = query
+            return False
+        now = time.time()
+        if self.query_time is not None and now - self.query_time < self.query_timeout:
+            return False
+        self.query_time = now
+        return True
+
+    def start(self):
+        """加载当天的合约信息，之后定期检查日期变化"""
+        self.load_snapshot(datetime.today().strftime('%Y%m%d'))
+        self.refresh()
+        if not self.refresher.is_running():
+            self.refresher.start()
+
+    def refresh(self):
+        """日期变化时在后台线程重新加载"""
+        day = datetime.today().strftime('%Y%m%d')
+        if day == self.day or self.loading:
+            return
+        self.loading = True
+        future = self.executor.submit(self.load, day)
+        IOLoop.current().add_future(future, lambda f: self.on_loaded(day, f))
+
+    def load_snapshot(self, day):
+        """读本地快照文件"""
+        path = snapshot_path(day)
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as f:
+                rows = json.load(f)
+        except (IOError, ValueError) as exp:
+            logging.error('load instrument snapshot failed: %s', exp)
+            return False
+        self.update(day, rows)
+        logging.info('load %s instruments of %s from %s', len(rows), day, path)
+        return True
+
+    def load(self, day):
+        """后台线程中执行"""
+        return [json.loads(value) for value in self.redis.hvals(instrument_key(day))]
+
+    def on_loaded(self, day, future):
+        self.loading = False
+        try:
+            rows = future.result()
+        except Exception as exp:
+            logging.error('load instruments failed: %s', exp)
+            return
+        if rows:
+            self.update(day, rows)
+        logging.info('load %s instruments of %s', len(rows), day)
+        if self.day != day:
+            self.requery()
+
+    def requery(self):
+        """redis中还没有当天的合约表，由池中已就绪的会话或加载期间被拒绝的会话查询"""
+        query, self.waiting = self.waiting, None
+        if self.query_source is not None:
+            query = self.query_source() or query
+        if query is not None and self.claim():
+            logging.info('query instruments of %s', datetime.today().strftime('%Y%m%d'))
+            query()
+
+    def update(self, day, rows):
+        """
+        用一次完整的合约查询结果替换合约表
+        :param day: 日期，YYYYMMDD
+        :param rows: 合约信息列表
+        """
+        instruments = {}
+        for row in rows:
+            instruments[row['InstrumentID']] = Instrument(row)
+        self.instruments = instruments
+        self.day = day
+        self.query_time = None
+
+    def save(self, day, rows):
+        """在后台线程把合约信息一次性写入redis和本地快照"""
+        self.executor.submit(self.write, day, rows)
+        self.executor.submit(self.write_snapshot, day, rows)
+
+    def write(self, day, rows):
+        """后台线程中执行，所有合约用一个pipeline写入"""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            key = instrument_key(day)
+            for row in rows:
+                pipe.hset(key, row['InstrumentID'], json.dumps(row))
+            pipe.execute()
+        except Exception as exp:
+            logging.error('save instruments failed: %s', exp)
+        else:
+            logging.info('save %s instruments of %s', len(rows), day)
+
+    @staticmethod
+    def write_snapshot(day, rows):
+        """后台线程中执行，先写临时文件再改名，启动时不会读到写了一半的快照"""
+        path = snapshot_path(day)
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(rows, f)
+            os.rename(path + '.tmp', path)
+            # 只保留当天的快照
+            for name in os.listdir(directory):
+                if name != os.path.basename(path):
+                    os.remove(os.path.join(directory, name))
+        except (IOError, OSError) as exp:
+            logging.error('save instrument snapshot failed: %s', exp)
+
+
+instrument_registry = InstrumentRegistry()
@@ -0,0 +1,232 @@
+# -*- coding:utf-8 -*-
+
+import logging
+
+from tornado import gen
+
+from constant import Direction, Offset, OrderStatus, PosiDirection, PositionDate
+from event import PositionEvent
+from instrument import instrument_registry
+from registry import CtpError
+from stream import DeltaStream
+
+
+def volume_multiple(symbol):
+    """合约乘数，合约表中没有时为1"""
+    instrument = instrument_registry.get(symbol)
+    return instrument.volume_multiple if instrument is not None else 1
+
+
+def merge_positions(rows):
+    """
+    把一次持仓查询的全部回报按(合约, 方向)合并
+    :param rows: [PositionEvent]，上期所今昨仓分两条
+    :return: {(InstrumentID, PosiDirection): Position}
+    """
+    positions = {}
+    for row in rows:
+        key = (row.symbol, row.direction)
+        position = positions.get(key)
+        if position is None:
+            position = positions[key] = Position(row.symbol, row.direction)
+        if row.data['PositionDate'] == PositionDate.HISTORY:
+            # 上期所昨仓单独一条
+            position.yd += row.position
+        else:
+            position.today += row.data['TodayPosition']
+            position.yd += row.position - row.data['TodayPosition']
+        position.cost += row.data.get('PositionCost', 0)
+        position.profit += row.data.get('PositionProfit', 0)
+    return positions
+
+
+class Position(object):
+    """一个合约一个方向的持仓"""
+
+    __slots__ = ('symbol', 'direction', 'today', 'yd', 'frozen', 'cost', 'profit')
+
+    def __init__(self, symbol, direction):
+        self.symbol = symbol
+        self.direction = direction  # PosiDirection
+        self.today = 0   # 今仓
+        self.yd = 0      # 昨仓
+        self.frozen = 0  # 未成交平仓报单冻结的数量
+        self.cost = 0.0  # 持仓成本（价格 × 数量 × 合约乘数）
+        self.profit = 0.0  # 持仓盈亏，取自最近一次查询
+
+    @property
+    def position(self):
+        return self.today + self.yd
+
+    @property
+    def price(self):
+        """持仓均价"""
+        size = volume_multiple(self.symbol)
+        return self.cost / (self.position * size) if self.position and size else 0.0
+
+    def open(self, volume, price):
+        self.today += volume
+        self.cost += price * volume * volume_multiple(self.symbol)
+
+    def close(self, volume, offset):
+        """平仓：平今只减今仓，平昨只减昨仓，其余先平昨仓再平今仓；均价不变"""
+        if self.position > 0:
+            self.cost -= self.cost * min(volume, self.position) / self.position
+        if offset == Offset.CLOSE_TODAY:
+            self.today -= volume
+        elif offset == Offset.CLOSE_YESTERDAY:
+            self.yd -= volume
+        else:
+            yd = min(self.yd, volume)
+            self.yd -= yd
+            self.today -= volume - yd
+
+    def to_event(self):
+        return PositionEvent({
+            'InstrumentID': self.symbol,
+            'PosiDirection': self.direction,
+            'Position': self.position,
+            'TodayPosition': self.today,
+            'YdPosition': self.yd,
+            'Frozen': self.frozen,
+            'PositionCost': self.cost,
+            'PositionProfit': self.profit,
+            'Price': self.price,
+        })
+
+
+class PositionLedger(object):
+    """
+    一个账户的持仓账本，只在IOLoop线程中使用
+
+    有订阅者时先查询一次持仓作为起点，之后由成交回报增减持仓、由平仓报单回报计算冻结数量，
+    只把变化的持仓行立即推送给订阅者；每隔reconcile_interval秒用一次完整查询校正。没有订阅者时停止。
+    """
+
+    def __init__(self, query, reconcile_interval=60):
+        self.query = query  # 返回Future的持仓查询函数，结果为[PositionEvent]
+        self.reconcile_interval = reconcile_interval  # 校正周期（秒）
+        self.positions = {}  # (InstrumentID, PosiDirection) -> Position
+        self.closing = {}  # 未结束的平仓报单，order_key -> ((InstrumentID, PosiDirection), 未成交数量)
+        self.trade_ids = set()  # 已计入的成交，(ExchangeID, TradeID)
+        self.trade_count = 0  # 已计入的成交数，校正时判断查询期间是否有成交
+        self.stream = DeltaStream(self.snapshot)
+        self.loaded = False
+        self.running = False
+
+    def subscribe(self):
+        """
+        :return: tornado.queues.Queue，元素为StreamEvent，data为全部持仓或变化的持仓行
+        """
+        queue = self.stream.subscribe()
+        if not self.running:
+            self.running = True
+            self.run()
+        return queue
+
+    def unsubscribe(self, queue):
+        self.stream.unsubscribe(queue)
+
+    def reset(self):
+        """新交易日：成交编号可能与上一交易日重复，清空去重集合和上一交易日的平仓报单，立即校正"""
+        self.trade_ids.clear()
+        self.closing.clear()
+        if self.running:
+            self.reconcile()
+
+    def snapshot(self):
+        if not self.loaded:
+            return None
+        return [position.to_event().data for position in self.positions.itervalues()]
+
+    @gen.coroutine
+    def run(self):
+        try:
+            while self.stream:
+                yield self.reconcile()
+                yield gen.sleep(self.reconcile_interval if self.loaded else 1)
+        finally:
+            self.running = False
+            self.loaded = False
+
+    @gen.coroutine
+    def reconcile(self):
+        """查询全部持仓，查询期间没有新成交时用结果替换账本"""
+        trade_count = self.trade_count
+        try:
+            rows = yield self.query()
+        except CtpError as exp:
+            logging.warning('position query failed: %s', exp)
+            return
+        if self.loaded and self.trade_count != trade_count:
+            # 查询结果是否包含期间的成交无法确定，等下一次校正
+            return
+
+        positions = merge_positions(rows)
+        for key, volume in self.closing.itervalues():
+            if key in positions:
+                positions[key].frozen += volume
+
+        changed = [positions.get(key) or Position(*key) for key in set(positions) | set(self.positions)
+                   if self.differs(self.positions.get(key), positions.get(key))]
+        self.positions = positions
+        if not self.loaded:
+            self.loaded = True
+            self.trade_ids.clear()
+            self.stream.publish_snapshot()
+        elif changed:
+            logging.info('position ledger reconciled %s rows', len(changed))
+            self.publish(changed)
+
+    @staticmethod
+    def differs(old, new):
+        if old is None or new is None:
+            return (old or new).position != 0
+        return (old.today, old.yd, old.frozen, old.cost, old.profit) != \
+            (new.today, new.yd, new.frozen, new.cost, new.profit)
+
+    def position(self, symbol, direction):
+        key = (symbol, direction)
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = Position(symbol, direction)
+        return position
+
+    def on_trade(self, event):
+        """onRtnTrade"""
+        if not self.loaded:
+            return
+        trade_key = (event.exchange_id, event.trade_id)
+        if trade_key in self.trade_ids:
+            return
+        self.trade_ids.add(trade_key)
+        self.trade_count += 1
+
+        if event.offset == Offset.OPEN:
+            direction = PosiDirection.LONG if event.direction == Direction.LONG else PosiDirection.SHORT
+            position = self.position(event.symbol, direction)
+            position.open(event.volume, event.price or 0.0)
+        else:
+            # 买平平空头，卖平平多头
+            direction = PosiDirection.SHORT if event.direction == Direction.LONG else PosiDirection.LONG
+            position = self.position(event.symbol, direction)
+            position.close(event.volume, event.offset)
+        self.publish([position])
+
+    def on_order(self, event):
+        """onRtnOrder，平仓报单未成交的部分计入冻结"""
+        if not event.offset or event.offset == Offset.OPEN:
+            return
+        direction = PosiDirection.SHORT if event.direction == Direction.LONG else PosiDirection.LONG
+        key = (event.symbol, direction)
+        volume = 0 if event.status in OrderStatus.finished else event.volume - event.traded
+        old = self.closing.pop(event.key, (key, 0))[1]
+        if volume:
+            self.closing[event.key] = (key, volume)
+        if volume != old and self.loaded:
+            position = self.position(event.symbol, direction)
+            position.frozen += volume - old
+            self.publish([position])
+
+    def publish(self, positions):
+        self.stream.publish([position.to_event().data for position in positions])
@@ -0,0 +1,191 @@
+# -*- coding:utf-8 -*-
+
+from tornado.queues import Queue
+
+from constant import OrderStatus
+
+
+def order_key(front_id, session_id, order_ref):
+    """CTP中唯一确定一笔报单的键"""
+    return int(front_id), int(session_id), str(order_ref).strip()
+
+
+class Order(object):
+    """本地维护的一笔报单"""
+
+    def __init__(self, key, symbol=None, exchange_id=None):
+        self.key = key
+        self.symbol = symbol
+        self.exchange_id = exchange_id
+        self.order_sys_id = None
+        self.status = OrderStatus.PENDING
+        self.volume = 0          # 报单数量
+        self.traded = 0          # 已成交数量
+        self.data = None         # 最近一次onRtnOrder回报，OrderEvent
+        self.trades = []         # 成交回报，TradeEvent
+        self.trade_ids = set()   # 已收到的成交编号，重连回放时去重
+        self.watchers = set()    # 关注该报单回报的队列
+
+    @property
+    def active(self):
+        return self.status not in OrderStatus.finished
+
+    @property
+    def settled(self):
+        """报单已结束且成交回报都已收到"""
+        return not self.active and sum(trade.volume for trade in self.trades) >= self.traded
+
+    def update(self, status, traded=None):
+        """
+        状态迁移：已结束的报单不再回到未结束状态（重连后回放的旧回报可能乱序）
+        :return: 是否接受了这次迁移
+        """
+        if not self.active and status not in OrderStatus.finished:
+            return False
+        self.status = status
+        if traded is not None:
+            self.traded = max(self.traded, traded)
+        return True
+
+    def notify(self, event):
+        for queue in self.watchers:
+            queue.put_nowait(event)
+
+
+class TaggedQueue(object):
+    """多个报单共用一个队列时，给每条回报加上标签，元素为(tag, event)"""
+
+    def __init__(self, queue, tag):
+        self.queue = queue
+        self.tag = tag
+
+    def put_nowait(self, item):
+        self.queue.put_nowait((self.tag, item))
+
+
+class OrderBook(object):
+    """
+    一个账户的本地报单簿，只在IOLoop线程中使用
+
+    主键为(FrontID, SessionID, OrderRef)，另有OrderSysID和合约代码两个索引，
+    onRtnOrder和onRtnTrade都可以O(1)找到对应报单并通知关注它的请求。
+    """
+
+    def __init__(self):
+        self.orders = {}     # (FrontID, SessionID, OrderRef) -> Order
+        self.sys_ids = {}    # (ExchangeID, OrderSysID) -> Order
+        self.symbols = {}    # InstrumentID -> {Order}
+        self.pending_trades = {}  # 先于onRtnOrder到达的成交，(ExchangeID, OrderSysID) -> [TradeEvent]
+        self.watchers = {}   # 报单簿中还没有的报单（如撤其他会话的报单），(FrontID, SessionID, OrderRef) -> {queue}
+        self.trading_day = None
+
+    def reset(self, trading_day):
+        """新交易日清空报单簿"""
+        self.orders.clear()
+        self.sys_ids.clear()
+        self.symbols.clear()
+        self.pending_trades.clear()
+        self.trading_day = trading_day
+
+    def get(self, key):
+        return self.orders.get(key)
+
+    def add(self, key, symbol, volume=0, exchange_id=None):
+        order = self.orders.get(key)
+        if order is None:
+            order = Order(key, symbol, exchange_id)
+            order.watchers = self.watchers.pop(key, set())
+            self.orders[key] = order
+            if symbol is not None:
+                self.symbols.setdefault(symbol, set()).add(order)
+        if volume:
+            order.volume = volume
+        return order
+
+    def working(self, symbol=None):
+        """
+        未结束的报单
+        :param symbol: 为None时返回所有合约
+        :return: [Order]
+        """
+        if symbol is None:
+            orders = self.orders.itervalues()
+        else:
+            orders = self.symbols.get(symbol, ())
+        return [order for order in orders if order.active]
+
+    def watch(self, key, queue=None):
+        """
+        关注一笔报单的回报
+        :param key: order_key()
+        :param queue: 接收回报的队列，缺省时新建
+        :return: tornado.queues.Queue，元素为event.Event
+        """
+        if queue is None:
+            queue = Queue()
+        order = self.orders.get(key)
+        if order is None:
+            # 不为未知的报单建条目，收到onRtnOrder时再转给报单
+            self.watchers.setdefault(key, set()).add(queue)
+        else:
+            order.watchers.add(queue)
+        return queue
+
+    def unwatch(self, key, queue):
+        order = self.orders.get(key)
+        if order is not None:
+            order.watchers.discard(queue)
+        watchers = self.watchers.get(key)
+        if watchers is not None:
+            watchers.discard(queue)
+            if not watchers:
+                del self.watchers[key]
+
+    def on_order(self, event):
+        """onRtnOrder"""
+        order = self.add(event.key, event.symbol, event.volume, event.exchange_id)
+        if order.symbol is None:
+            order.symbol = event.symbol
+            self.symbols.setdefault(order.symbol, set()).add(order)
+        order.exchange_id = event.exchange_id
+        if not order.update(event.status, event.traded):
+            return
+        order.data = event
+
+        sys_id = event.order_sys_id
+        if sys_id and order.order_sys_id is None:
+            order.order_sys_id = sys_id
+            self.sys_ids[(order.exchange_id, sys_id)] = order
+
+        order.notify(event)
+        if sys_id:
+            for trade in self.pending_trades.pop((order.exchange_id, sys_id), ()):
+                self.on_trade(trade)
+
+    def on_trade(self, event):
+        """onRtnTrade，按交易所报单编号找到所属报单"""
+        sys_key = (event.exchange_id, event.order_sys_id)
+        order = self.sys_ids.get(sys_key)
+        if order is None:
+            self.pending_trades.setdefault(sys_key, []).append(event)
+            return
+        if event.trade_id in order.trade_ids:
+            return
+        order.trade_ids.add(event.trade_id)
+        order.trades.append(event)
+        order.notify(event)
+
+    def on_error(self, key, event):
+        """
+        报单、撤单错误回报
+        :param key: order_key()
+        :param event: ErrorEvent
+        """
+        order = self.orders.get(key)
+        if order is None:
+            for queue in self.watchers.get(key, ()):
+                queue.put_nowait(event)
+            return
+        if event.msg_type in ('onRspOrderInsert', 'onErrRtnOrderInsert'):
+            order.update(OrderStatus.REJECTED)
+        order.notify(event)
@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+
+import logging
+
+import redis
+from concurrent.futures import ThreadPoolExecutor  # `pip install futures` for python2
+from tornado.ioloop import IOLoop
+
+from registry import CtpError
+
+executor = ThreadPoolExecutor(max_workers=1)  # 所有会话共用的后台租约线程
+
+
+class OrderRefAllocator(object):
+    """
+    一个会话的报单引用分配器，只在IOLoop线程中使用
+
+    用redis的INCRBY按账户一次租一段编号（默认1000个），之后从内存中递增分配，发单时不访问网络。
+    当前段用掉大半时在后台线程预租下一段。计数器按账户共用，多个进程、多个会话拿到的编号互不重复，
+    同一会话内单调递增，且大于登录回报中的MaxOrderRef。
+    """
+
+    def __init__(self, broker_id, user_id, block=1000, client=None):
+        self.key = 'ORDER_REF:{}:{}'.format(broker_id, user_id)
+        self.block = block  # 每次租用的编号数
+        self.redis = client or redis.Redis(host='localhost', port=6379)
+        self.next_ref = 1  # 下一个分配的编号
+        self.end = 0  # 当前段的最后一个编号，next_ref > end时当前段已用完
+        self.spare = None  # 预租的下一段(start, end)
+        self.prefetching = False
+
+    def seed(self, max_order_ref):
+        """
+        登录后用MaxOrderRef设置下限，之前租到的比它小的编号不再使用
+        :param max_order_ref: 登录回报中的MaxOrderRef
+        """
+        self.next_ref = max(self.next_ref, max_order_ref + 1)
+        if self.spare is not None and self.spare[1] < self.next_ref:
+            self.spare = None
+        self.prefetch()
+
+    def allocate(self):
+        """
+        :return: OrderRef字符串
+        :raise CtpError: redis不可用、无法租到编号
+        """
+        if self.next_ref > self.end:
+            self.switch()
+        order_ref = self.next_ref
+        self.next_ref += 1
+        if self.end - self.next_ref < self.block // 5:
+            self.prefetch()
+        return str(order_ref)
+
+    def switch(self):
+        """当前段用完，换用预租的段，没有时同步租一段"""
+        spare, self.spare = self.spare, None
+        if spare is None or spare[1] < self.next_ref:
+            try:
+                spare = self.lease(self.next_ref)
+            except redis.RedisError as exp:
+                raise CtpError(-1, 'lease order ref failed: {}'.format(exp))
+        self.next_ref = max(self.next_ref, spare[0])
+        self.end = spare[1]
+
+    def lease(self, floor):
+        """
+        租一段编号，可在后台线程中执行
+        :param floor: 这一段的编号都不小于floor
+        :return: (start, end)
+        """
+        end = self.redis.incrby(self.key, self.block)
+        if end - self.block + 1 < floor:
+            # 计数器落后于MaxOrderRef（如redis被清空），一次跳过去
+            end = self.redis.incrby(self.key, floor - (end - self.block + 1))
+        return end - self.block + 1, end
+
+    def prefetch(self):
+        if self.prefetching or self.spare is not None:
+            return
+        self.prefetching = True
+        future = executor.submit(self.lease, max(self.next_ref, self.end + 1))
+        IOLoop.current().add_future(future, self.on_leased)
+
+    def on_leased(self, future):
+        self.prefetching = False
+        try:
+            self.spare = future.result()
+        except redis.RedisError as exp:
+            logging.error('prefetch order ref failed: %s', exp)
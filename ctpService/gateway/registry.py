@@ -0,0 +1,64 @@
+# -*- coding:utf-8 -*-
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+class CtpError(Exception):
+    """CTP请求失败（柜台返回错误或请求未能发出）"""
+
+    def __init__(self, error_id, error_msg):
+        super(CtpError, self).__init__(error_id, error_msg)
+        self.error_id = error_id
+        self.error_msg = error_msg
+
+    def to_dict(self):
+        return {'ErrorID': self.error_id, 'ErrorMsg': self.error_msg}
+
+
+class RequestRegistry(object):
+    """
+    请求与回报的对应表，只在IOLoop线程中使用
+
+    查询类请求按reqID登记一个Future，收集n/last分批返回的数据，last为True时一次性返回。
+    """
+
+    def __init__(self, timeout=10):
+        self.requests = {}  # reqID -> (Future, 已收到的数据)
+        self.timeout = timeout  # 查询回报超时时间（秒）
+
+    def register(self, req_id, ret=0, timeout=None):
+        """
+        登记一个请求
+        :param req_id: 请求编号
+        :param ret: req*函数的返回值，非0表示请求未发出（如超过流控）
+        :param timeout: 超时时间（秒），缺省为self.timeout
+        :return: Future，结果为回报数据列表
+        """
+        future = Future()
+        if ret != 0:
+            future.set_exception(CtpError(ret, 'request not sent, return code {}'.format(ret)))
+            return future
+        self.requests[req_id] = (future, [])
+        IOLoop.current().call_later(timeout or self.timeout, self.expire, req_id)
+        return future
+
+    def expire(self, req_id):
+        entry = self.requests.pop(req_id, None)
+        if entry is not None:
+            entry[0].set_exception(CtpError(-1, 'request {} timeout'.format(req_id)))
+
+    def on_response(self, req_id, data, error, last):
+        entry = self.requests.get(req_id)
+        if entry is None:
+            return
+        future, rows = entry
+        if error and error.get('ErrorID'):
+            del self.requests[req_id]
+            future.set_exception(CtpError(error['ErrorID'], error.get('ErrorMsg')))
+            return
+        if data:
+            rows.append(data)
+        if last:
+            del self.requests[req_id]
+            future.set_result(rows)
@@ -0,0 +1,172 @@
+# -*- coding:utf-8 -*-
+
+import logging
+from collections import deque
+
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import IOLoop
+
+from registry import CtpError
+
+# req*函数超过流控时的返回值：-2未处理请求超过许可数，-3每秒发送请求数超过许可数
+FLOW_CONTROL_ERRORS = (-2, -3)
+
+
+class Lane(object):
+    """
+    一条请求通道，按令牌桶限速
+
+    :param rate: 每秒发送的请求数
+    :param burst: 令牌桶容量
+    :param max_inflight: 未收到回报的请求数上限，None为不限
+    """
+
+    def __init__(self, name, rate, burst=1, max_inflight=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.tokens = burst
+        self.updated = IOLoop.current().time()
+        self.jobs = deque()  # (func, key, Future, 入队时间)
+        self.keys = {}  # 排队或执行中的请求去重，key -> Future
+        self.inflight = 0
+
+        self.submitted = 0
+        self.sent = 0
+        self.retried = 0  # 被柜台流控后重发的次数
+        self.deduped = 0  # 合并到相同请求的次数
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now):
+        """是否可以立即发出下一个请求"""
+        if self.max_inflight is not None and self.inflight >= self.max_inflight:
+            return False
+        self.refill(now)
+        return self.tokens >= 1
+
+    def delay(self):
+        """距离下一个令牌的秒数"""
+        return max(1 - self.tokens, 0) / self.rate
+
+    def metrics(self):
+        return {
+            'depth': len(self.jobs),
+            'inflight': self.inflight,
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'retried': self.retried,
+            'deduped': self.deduped,
+            'wait_avg': self.wait_total / self.sent if self.sent else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+
+class Scheduler(object):
+    """
+    一个会话所有req*请求的调度器，只在IOLoop线程中使用
+
+    报单撤单走trade通道，查询走query通道，两条通道各自限速，trade通道优先且不会被查询阻塞。
+    相同key的查询在排队或执行中时直接共用结果。
+    """
+
+    TRADE = 'trade'
+    QUERY = 'query'
+
+    def __init__(self, trade_rate=20, trade_burst=20, query_rate=1):
+        # CTP查询每秒1次，且上一个查询回报前不能发下一个
+        self.lanes = [
+            Lane(self.TRADE, trade_rate, trade_burst),
+            Lane(self.QUERY, query_rate, 1, max_inflight=1),
+        ]
+        self.timer = None
+
+    def lane(self, name):
+        for lane in self.lanes:
+            if lane.name == name:
+                return lane
+        raise KeyError(name)
+
+    def submit(self, name, func, key=None):
+        """
+        提交一个请求
+        :param name: TRADE or QUERY
+        :param func: 发出请求的函数，失败时抛CtpError；返回Future时等其完成
+        :param key: 去重键，为None时不去重
+        :return: Future，结果为func的返回值
+        """
+        lane = self.lane(name)
+        if key is not None and key in lane.keys:
+            lane.deduped += 1
+            return lane.keys[key]
+
+        future = Future()
+        lane.submitted += 1
+        lane.jobs.append((func, key, future, IOLoop.current().time()))
+        if key is not None:
+            lane.keys[key] = future
+            future.add_done_callback(lambda f: lane.keys.pop(key, None))
+        self.schedule()
+        return future
+
+    def schedule(self):
+        if self.timer is not None:
+            IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+
+        delay = None
+        for lane in self.lanes:
+            while lane.jobs:
+                now = IOLoop.current().time()
+                if not lane.ready(now):
+                    if lane.max_inflight is None or lane.inflight < lane.max_inflight:
+                        # 等令牌；等回报的通道由回报触发
+                        delay = lane.delay() if delay is None else min(delay, lane.delay())
+                    break
+                self.dispatch(lane, now)
+
+        if delay is not None:
+            self.timer = IOLoop.current().call_later(delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.schedule()
+
+    def dispatch(self, lane, now):
+        func, key, future, submit_time = lane.jobs.popleft()
+        lane.tokens -= 1
+        try:
+            result = func()
+        except CtpError as exp:
+            if exp.error_id in FLOW_CONTROL_ERRORS:
+                # 柜台流控，放回队首，等下一个令牌重发
+                logging.warning('%s request flow controlled: %s', lane.name, exp)
+                lane.retried += 1
+                lane.tokens = min(lane.tokens, 0)
+                lane.jobs.appendleft((func, key, future, submit_time))
+            else:
+                future.set_exception(exp)
+            return
+
+        wait = now - submit_time
+        lane.sent += 1
+        lane.wait_total += wait
+        lane.wait_max = max(lane.wait_max, wait)
+        if isinstance(result, Future):
+            lane.inflight += 1
+            result.add_done_callback(lambda f: self.on_done(lane))
+            chain_future(result, future)
+        else:
+            future.set_result(result)
+
+    def on_done(self, lane):
+        lane.inflight -= 1
+        self.schedule()
+
+    def metrics(self):
+        return dict((lane.name, lane.metrics()) for lane in self.lanes)
@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+
+import logging
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from constant import TopicMode
+from trader import NewTrader
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format='%(threadName)s %(levelname)s || %(asctime)s || %(message)s'
+)
+
+
+class SessionError(Exception):
+    """会话建立失败（登录失败或超时）"""
+
+
+class Session(object):
+    """池中的一个交易会话"""
+
+    def __init__(self, key, trader, password):
+        self.key = key
+        self.trader = trader
+        self.password = password
+        self.refs = 0  # 正在使用该会话的请求数
+        self.last_used = time.time()
+        self.retired = False  # 已被新会话替换，引用归零后关闭
+
+
+class SessionManager(object):
+    """
+    进程内共享的CTP交易会话池
+
+    按(broker_id, user_id, address)保存已登录的NewTrader，所有HTTP请求复用同一个会话，
+    避免每个请求都重新连接前置、登录、确认结算单和查询合约。
+    """
+
+    def __init__(self, login_timeout=10, idle_timeout=30 * 60, reap_interval=60, topic_mode=TopicMode.RESUME):
+        self.sessions = {}  # (broker_id, user_id, address) -> 已登录的Session
+        self.pending = {}   # (broker_id, user_id, address, password) -> 正在登录的Session
+        self.login_timeout = login_timeout  # 等待会话就绪的超时时间（秒）
+        self.idle_timeout = idle_timeout    # 无人使用的会话保留时间（秒）
+        self.topic_mode = topic_mode        # 新会话私有流、公共流的订阅方式
+        self.ticks = None                   # 资金估算用的行情源
+        self.account_options = {}           # 资金估算参数，见AccountEstimator
+        self.reaper = PeriodicCallback(self.reap, reap_interval * 1000)
+
+    @gen.coroutine
+    def acquire(self, user_id, password, broker_id, address):
+        """
+        获取已就绪的交易会话，不存在时新建并等待登录完成
+        :param user_id:
+        :param password:
+        :param broker_id:
+        :param address:
+        :return: NewTrader
+        """
+        key = (broker_id, user_id, address)
+        session = self.sessions.get(key)
+        if session is None or session.password != password:
+            # 密码不一致时不复用已有会话，用新密码单独登录，成功后才替换旧会话
+            session = self.pending.get(key + (password,))
+            if session is None:
+                session = self.open(key, user_id, password, broker_id, address)
+
+        session.refs += 1
+        session.last_used = time.time()
+        try:
+            yield self.wait_ready(session)
+        except SessionError:
+            self.release(session.trader)
+            raise
+        self.promote(session)
+        raise gen.Return(session.trader)
+
+    def release(self, trader):
+        """请求结束后归还会话，会话保持登录状态供后续请求使用"""
+        session = trader.session
+        session.refs = max(session.refs - 1, 0)
+        session.last_used = time.time()
+        if session.retired and session.refs == 0:
+            self.close_session(session)
+
+    def open(self, key, user_id, password, broker_id, address):
+        logging.info('open trading session: %s', key)
+        trader = NewTrader(user_id, password, broker_id, address, self.topic_mode, self.ticks, self.account_options)
+        session = Session(key, trader, password)
+        trader.session = session
+        trader.start()
+        self.pending[key + (password,)] = session
+        if not self.reaper.is_running():
+            self.reaper.start()
+        return session
+
+    def promote(self, session):
+        """登录成功的会话放入池中，替换同一账户的旧会话"""
+        self.pending.pop(session.key + (session.password,), None)
+        old = self.sessions.get(session.key)
+        if old is session:
+            return
+        self.sessions[session.key] = session
+        if old is not None:
+            self.retire(old)
+
+    @gen.coroutine
+    def wait_ready(self, session):
+        trader = session.trader
+        deadline = IOLoop.current().time() + self.login_timeout
+        while not trader.ready:
+            if trader.login_failed:
+                self.evict(session)
+                raise SessionError('login failed')
+            notified = yield trader.status_changed.wait(timeout=deadline)
+            if not notified:
+                self.evict(session)
+                raise SessionError('login timeout')
+
+    def evict(self, session):
+        self.pending.pop(session.key + (session.password,), None)
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+        self.retire(session)
+
+    def retire(self, session):
+        session.retired = True
+        if session.refs == 0:
+            self.close_session(session)
+
+    def reap(self):
+        """关闭长时间无人使用的会话"""
+        now = time.time()
+        for session in self.sessions.values():
+            if session.refs == 0 and now - session.last_used > self.idle_timeout:
+                logging.info('close idle trading session: %s', session.key)
+                self.evict(session)
+
+    def instrument_query(self):
+        """
+        :return: 池中一个已就绪会话的合约查询函数，没有时返回None
+        """
+        for session in self.sessions.values():
+            if not session.retired and session.trader.ready:
+                return session.trader.query_instruments
+        return None
+
+    @staticmethod
+    def close_session(session):
+        if session.trader.connecting:
+            session.trader.close()
+
+
+session_manager = SessionManager()
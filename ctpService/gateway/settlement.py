@@ -0,0 +1,65 @@
+# -*- coding:utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor  # `pip install futures` for python2
+
+
+class SettlementCache(object):
+    """
+    已确认结算单的账户，按交易日记录
+
+    CTP回调线程登录成功后查询，命中时跳过结算单确认；记录保存在本地文件，启动时加载，
+    进程重启后当天再登录也不用重新确认。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(os.getcwd(), 'trade_connect', 'settlement_confirmed.json')
+        self.confirmed = set()  # (BrokerID, InvestorID, TradingDay)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                rows = json.load(f)
+        except (IOError, ValueError) as exp:
+            logging.error('load settlement confirm cache failed: %s', exp)
+            return
+        with self.lock:
+            self.confirmed = set(tuple(str(item) for item in row) for row in rows)
+        logging.info('load %s settlement confirmations', len(rows))
+
+    def is_confirmed(self, broker_id, user_id, trading_day):
+        return (broker_id, user_id, trading_day) in self.confirmed
+
+    def add(self, broker_id, user_id, trading_day):
+        """记录确认，并丢弃更早交易日的记录；文件在后台线程写入"""
+        with self.lock:
+            if (broker_id, user_id, trading_day) in self.confirmed:
+                return
+            confirmed = set(row for row in self.confirmed if row[2] >= trading_day)
+            confirmed.add((broker_id, user_id, trading_day))
+            self.confirmed = confirmed
+            rows = sorted(confirmed)
+        self.executor.submit(self.write, rows)
+
+    def write(self, rows):
+        """后台线程中执行"""
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(rows, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as exp:
+            logging.error('save settlement confirm cache failed: %s', exp)
+
+
+settlement_cache = SettlementCache()
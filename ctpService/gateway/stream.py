@@ -0,0 +1,65 @@
+# -*- coding:utf-8 -*-
+
+from tornado.queues import Queue
+
+from event import StreamEvent
+
+
+class DeltaStream(object):
+    """
+    快照加增量的推送，只在IOLoop线程中使用
+
+    订阅时先收到一条全量snapshot，之后只收到变化的delta，每条消息只编码一次、所有订阅者共用。
+    客户端积压超过max_pending条时丢弃积压，改发一条最新的snapshot，客户端按seq重新同步。
+    """
+
+    SNAPSHOT = 'snapshot'
+    DELTA = 'delta'
+
+    def __init__(self, snapshot, max_pending=10):
+        self.snapshot = snapshot  # 返回当前全量数据的函数，数据未就绪时返回None
+        self.max_pending = max_pending
+        self.seq = 0  # 最近一条消息的序号
+        self.subscribers = set()
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self):
+        """
+        :return: tornado.queues.Queue，元素为StreamEvent
+        """
+        queue = Queue()
+        data = self.snapshot()
+        if data is not None:
+            queue.put_nowait(StreamEvent(self.SNAPSHOT, self.seq, data))
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish_snapshot(self):
+        self.seq += 1
+        event = StreamEvent(self.SNAPSHOT, self.seq, self.snapshot())
+        for queue in self.subscribers:
+            self.drain(queue)
+            queue.put_nowait(event)
+
+    def publish(self, delta):
+        self.seq += 1
+        event = StreamEvent(self.DELTA, self.seq, delta)
+        snapshot = None
+        for queue in self.subscribers:
+            if queue.qsize() >= self.max_pending:
+                if snapshot is None:
+                    snapshot = StreamEvent(self.SNAPSHOT, self.seq, self.snapshot())
+                self.drain(queue)
+                queue.put_nowait(snapshot)
+            else:
+                queue.put_nowait(event)
+
+    @staticmethod
+    def drain(queue):
+        while queue.qsize():
+            queue.get_nowait()
@@ -1,15 +1,22 @@
 # -*- coding:utf-8 -*-
 
+import json
 import logging
-import threading
 import time
-from Queue import Queue, Empty
 from datetime import datetime
 
-import redis
+from tornado import gen
+from tornado.locks import Condition
 
 from constant import *
+from estimator import AccountEstimator
 from gateway import CtpTdApi
+from instrument import instrument_registry
+from ledger import PositionLedger
+from order_book import OrderBook, order_key
+from order_ref import OrderRefAllocator
+from registry import RequestRegistry, CtpError
+from scheduler import Scheduler
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -17,21 +24,93 @@ logging.basicConfig(
 )
 
 
-class NewTrader(threading.Thread):
+class NewTrader(object):
 
-    def __init__(self, user_id, password, broker_id, address):
-        super(NewTrader, self).__init__()
+    def __init__(self, user_id, password, broker_id, address, topic_mode=TopicMode.RESUME, ticks=None,
+                 account_options=None):
         self.user_id = user_id
         self.password = password
         self.broker_id = broker_id
         self.address = address
 
-        self.queue = Queue()
-        self.td_api = CtpTdApi(user_id, password, broker_id, address, self.queue)
-        self.redis = redis.Redis(host='localhost', port=6379)
-        self.order_id_key = 'UNIQUE_ORDER_ID'
+        self.registry = RequestRegistry()  # 请求编号与查询回报的对应表
+        self.scheduler = Scheduler()  # 所有req*请求按流控排队发出
+        self.order_book = OrderBook()  # 本账户的报单簿
+        self.status_changed = Condition()  # 登录状态变化通知
+        self.td_api = CtpTdApi(user_id, password, broker_id, address, self, topic_mode)
+        self.order_refs = OrderRefAllocator(broker_id, user_id)  # 报单引用分配
         self.connect_time = None
         self.running = False
+        self.connecting = False
+        self.session = None  # 所属的会话池条目
+        self.orders_session = None  # 已查询过报单的(FrontID, SessionID)
+        self.positions = PositionLedger(self.query_position)  # 持仓账本，所有订阅者共用
+        self.account = AccountEstimator(self.query_account, self.positions, ticks,
+                                        **(account_options or {}))  # 资金估算，所有订阅者共用
+
+    @property
+    def ready(self):
+        """会话是否已登录并确认结算单"""
+        return self.td_api.ready
+
+    @property
+    def login_failed(self):
+        return self.td_api.loginFailed
+
+    def on_status(self):
+        """IOLoop中执行，唤醒等待登录结果的协程"""
+        if self.td_api.tradingDay and self.td_api.tradingDay != self.order_book.trading_day:
+            self.order_book.reset(self.td_api.tradingDay)
+            self.positions.reset()
+        if self.ready:
+            self.order_refs.seed(self.td_api.maxOrderRef)
+        if self.ready and self.orders_session != (self.td_api.frontID, self.td_api.sessionID):
+            # 之前会话发出的报单不一定会从私有流回放，登录后查询一次补进报单簿
+            self.orders_session = (self.td_api.frontID, self.td_api.sessionID)
+            self.query_orders()
+        if self.ready and instrument_registry.claim(self.query_instruments):
+            # 当天第一个登录的会话查询合约
+            self.query_instruments()
+        self.status_changed.notify_all()
+
+    def on_response(self, req_id, event, error, last):
+        """IOLoop中执行，查询响应按请求编号交给等待的Future"""
+        self.registry.on_response(req_id, event, error, last)
+
+    def on_message(self, event):
+        """IOLoop中执行，报单、成交及错误回报交给报单簿、资金估算和持仓账本"""
+        if event.msg_type == 'onRtnOrder':
+            self.order_book.on_order(event)
+            self.account.on_order(event)
+            self.positions.on_order(event)
+        elif event.msg_type == 'onRtnTrade':
+            self.order_book.on_trade(event)
+            self.account.on_trade(event)
+            self.positions.on_trade(event)
+        else:
+            key = self.order_key(event.order_ref, event.front_id, event.session_id)
+            self.order_book.on_error(key, event)
+
+    def on_instruments(self, day, rows):
+        """IOLoop中执行，合约查询结果更新进程内共享的合约表并写入redis"""
+        instrument_registry.update(day, rows)
+        instrument_registry.save(day, rows)
+
+    def order_key(self, order_ref, front_id=None, session_id=None):
+        """报单的(FrontID, SessionID, OrderRef)，前置和会话编号缺省为本会话"""
+        return order_key(front_id or self.td_api.frontID, session_id or self.td_api.sessionID, order_ref)
+
+    def watch_order(self, key, queue=None):
+        """
+        关注一个报单的回报
+        :param key: order_key()
+        :param queue: 接收回报的队列，缺省时新建
+        :return: tornado.queues.Queue，元素为(msg_type, data)
+        """
+        return self.order_book.watch(key, queue)
+
+    def unwatch_order(self, key, queue):
+        self.order_book.unwatch(key, queue)
 
     def connect(self):
         self.connecting = True
@@ -45,22 +124,18 @@ class NewTrader(threading.Thread):
         self.running = False
 
     def start(self):
-        super(NewTrader, self).start()
         self.connect()
         self.running = True
 
-    def run(self):
-        while self.running:
-            time.sleep(1)
-
     @property
     def order_id(self):
         """
-        :return:
+        :return: 新的OrderRef
         """
-        return self.redis.lpop(self.order_id_key)
+        return self.order_refs.allocate()
 
-    def send_order(self, symbol, price, volume, price_type, order_type, trade_date=None):
+    @gen.coroutine
+    def send_order(self, symbol, price, volume, price_type, order_type, trade_date=None, watcher=None):
         """
         发单
         :param symbol:
@@ -69,11 +144,12 @@ class NewTrader(threading.Thread):
         :param price_type: limit or market
         :param order_type:
         :param trade_date: 上期所订单平仓时需要，决定平今或平昨
-        :return:
+        :param watcher: 接收该报单回报的队列，在报单发出的同时关注，不会漏掉回报
+        :return: OrderRef
         """
         today_str = datetime.today().strftime('%Y%m%d')
         logging.info('trade_date = %s', trade_date)
-        exchange_id = self.redis.hget('SymbolExchangeMap', symbol)
+        exchange_id = instrument_registry.exchange_id(symbol)
         logging.info('in send_order exchange_id = %s', exchange_id)
         if price_type == 'market':
             order_price_type = PriceType.MARKET_PRICE
@@ -133,29 +209,81 @@ class NewTrader(threading.Thread):
             order['TimeCondition'] = '1'  # 立即完成，否则撤销
             order['VolumeCondition'] = '3'  # 全部数量
 
-        self.td_api.sendOrder(order)
+        def insert():
+            req_id, ret = self.td_api.sendOrder(order)
+            if ret != 0:
+                raise CtpError(ret, 'reqOrderInsert failed, return code {}'.format(ret))
+            key = self.order_key(order['OrderRef'])
+            self.order_book.add(key, symbol, order['VolumeTotalOriginal'], exchange_id)
+            if watcher is not None:
+                self.order_book.watch(key, watcher)
 
-    def get_order_message(self):
-        try:
-            msg = self.queue.get(block=False)
-            return msg
-        except Empty:
-            return None
+        yield self.scheduler.submit(Scheduler.TRADE, insert)
+        raise gen.Return(order['OrderRef'])
 
+    def request(self, req, timeout=None):
+        """
+        发出一个查询请求并登记，未能发出时抛CtpError，超过流控的由调度器重发
+        :param req: CtpTdApi的查询函数，返回(reqID, 发送结果)
+        :param timeout: 等待回报的超时时间（秒），缺省为登记表的默认值
+        :return: Future，结果为回报数据列表
+        """
+        req_id, ret = req()
+        if ret != 0:
+            raise CtpError(ret, 'request not sent, return code {}'.format(ret))
+        return self.registry.register(req_id, timeout=timeout)
+
+    @gen.coroutine
+    def query_instruments(self):
+        """查询全部合约，结果经on_instruments更新合约表；合约全部返回之前查询通道不发其他查询"""
+        try:
+            yield self.scheduler.submit(Scheduler.QUERY,
+                                        lambda: self.request(self.td_api.qryInstrument,
+                                                             timeout=instrument_registry.query_timeout),
+                                        key='qryInstrument')
+        except CtpError as exp:
+            logging.warning('query instruments failed: %s', exp)
+
+    @gen.coroutine
+    def query_orders(self):
+        """查询当日全部报单，按onRtnOrder处理，报单簿中已结束的报单不会被旧状态覆盖；失败时隔5秒重试"""
+        session = self.orders_session
+        while True:
+            try:
+                rows = yield self.scheduler.submit(Scheduler.QUERY, lambda: self.request(self.td_api.qryOrder),
+                                                   key='qryOrder')
+                break
+            except CtpError as exp:
+                logging.warning('query orders failed: %s', exp)
+            yield gen.sleep(5)
+            if not self.ready or self.orders_session != session:
+                # 会话已断开或重新登录，由新的登录重新查询
+                return
+        for event in rows:
+            self.on_message(event)
+        logging.info('load %s orders into order book', len(rows))
+
+    @gen.coroutine
     def query_account(self):
+        """
+        :return: AccountEvent
+        """
         logging.info('query_account time: %s', time.time())
-        self.td_api.qryAccount()
+        rows = yield self.scheduler.submit(Scheduler.QUERY, lambda: self.request(self.td_api.qryAccount),
+                                           key='qryAccount')
+        raise gen.Return(rows[0] if rows else None)
 
+    @gen.coroutine
     def query_position(self):
+        """
+        :return: [PositionEvent]，每个合约方向（上期所今昨仓分开）一条
+        """
         logging.info('query_position time: %s', time.time())
-        self.td_api.qryPosition()
-
-    def get_account(self):
-        return self.queue.get(block=False)
-
-    def get_position(self):
-        return self.queue.get(block=False)
+        rows = yield self.scheduler.submit(Scheduler.QUERY, lambda: self.request(self.td_api.qryPosition),
+                                           key='qryPosition')
+        raise gen.Return([row for row in rows if row.symbol])
 
+    @gen.coroutine
     def cancel_order(self, investor_id, broker_id, front_id, session_id, exchange_id, symbol, order_id):
         """
         :param investor_id:
@@ -177,10 +305,28 @@ class NewTrader(threading.Thread):
         req['ActionFlag'] = '0'
         req['BrokerID'] = broker_id
         req['InvestorID'] = investor_id
-        self.td_api.cancelOrder(req)
+        def action():
+            req_id, ret = self.td_api.cancelOrder(req)
+            if ret != 0:
+                raise CtpError(ret, 'reqOrderAction failed, return code {}'.format(ret))
 
+        yield self.scheduler.submit(Scheduler.TRADE, action)
+
+    @gen.coroutine
+    def cancel_book_order(self, order):
+        """
+        撤销报单簿中的一笔报单，合约、交易所和会话信息都取自报单簿
+        :param order: order_book.Order
+        :return:
+        """
+        if order.symbol is None or order.exchange_id is None:
+            raise CtpError(-1, 'order {} has no instrument or exchange yet'.format(order.key))
+        front_id, session_id, order_ref = order.key
+        yield self.cancel_order(self.user_id, self.broker_id, front_id, session_id, order.exchange_id,
+                                order.symbol, order_ref)
 
-class Trader(threading.Thread):
+
+class Trader(object):
 
     def __init__(self, callback):
         self.user_id = None
@@ -188,34 +334,42 @@ class Trader(threading.Thread):
         self.broker_id = None
         self.address = None
         self.td_api = None
-        self.queue = Queue()
         self.running = False
         self.connecting = False
-        self.order_id_key = 'UNIQUE_ORDER_ID'
-        self.cache = redis.Redis(host='localhost', port=6379)
+        self.order_refs = None
         self.callback = callback
-        super(Trader, self).__init__()
 
     def connect(self, user_id, password, broker_id, address):
         self.user_id = user_id
         self.password = password
         self.broker_id = broker_id
         self.address = address
-        self.td_api = CtpTdApi(user_id, password, broker_id, address, self.queue)
+        self.td_api = CtpTdApi(user_id, password, broker_id, address, self)
+        self.order_refs = OrderRefAllocator(broker_id, user_id)
         self.td_api.connect()
         self.connecting = True
 
-    def run(self):
-        while self.running:
-            try:
-                msg = self.queue.get(block=False)
-                self.callback(msg)
-            except Empty:
-                time.sleep(0.01)
+    def on_status(self):
+        if self.td_api.ready:
+            self.order_refs.seed(self.td_api.maxOrderRef)
+        if self.td_api.ready and instrument_registry.claim(self.td_api.qryInstrument):
+            self.td_api.qryInstrument()
+
+    def on_response(self, req_id, event, error, last):
+        if event is not None:
+            self.on_message(event)
+
+    def on_instruments(self, day, rows):
+        instrument_registry.update(day, rows)
+        instrument_registry.save(day, rows)
+
+    def on_message(self, event):
+        """IOLoop中执行，直接回调推送"""
+        if self.running:
+            self.callback(json.dumps({'msg_type': event.msg_type, 'data': event.data}))
 
     def start(self):
         self.running = True
-        super(Trader, self).start()
 
     def close(self):
         self.connecting = False
@@ -231,9 +385,9 @@ class Trader(threading.Thread):
     @property
     def order_id(self):
         """
-        :return:
+        :return: 新的OrderRef
         """
-        return self.cache.lpop(self.order_id_key)
+        return self.order_refs.allocate()
 
     def send_order(self, data):
         """
@@ -250,7 +404,7 @@ class Trader(threading.Thread):
 
         today_str = datetime.today().strftime('%Y%m%d')
         logging.info('trade_date = %s', trade_date)
-        exchange_id = self.cache.hget('SymbolExchangeMap', symbol)
+        exchange_id = instrument_registry.exchange_id(symbol)
         logging.info('in send_order exchange_id = %s', exchange_id)
         if price_type == 'market':
             order_price_type = PriceType.MARKET_PRICE
@@ -1,15 +1,33 @@
 # -*- coding:utf-8 -*-
 
-from threading import Thread
+import json
+import uuid
+from datetime import datetime
 
 import pika
-from tornado.queues import Queue
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Event
 
 from logger import logger
 
 
 class TickConsumer(object):
-    def __init__(self, exchange_id, queue_name, route_key=''):
+    """
+    一个行情exchange的消费者，运行在应用自己的IOLoop上，不单独起线程
+
+    连接断开或连接失败时按backoff等待后重连，等待时间从1秒起翻倍，最长max_backoff秒，
+    开始消费后重置。on_message回调在IOLoop中执行，参数为消息原文。
+    """
+
+    IDLE = 'idle'              # 未启动
+    CONNECTING = 'connecting'  # 正在建立连接、通道、队列
+    CONSUMING = 'consuming'    # 正在消费
+    WAITING = 'waiting'        # 等待重连
+    CLOSING = 'closing'        # 正在关闭
+    STOPPED = 'stopped'        # 已关闭
+
+    def __init__(self, exchange_id, queue_name, on_message, route_key='', max_backoff=30):
         self._connection = None
         self._channel = None
         self._closing = False
@@ -19,14 +37,28 @@ class TickConsumer(object):
         self._queue_name = queue_name
         self._route_key = route_key
 
-        self._active = False
-        self._thread = Thread(target=self.run)
-        self.queue = Queue()
+        self._on_message = on_message
+        self._ioloop = None
+        self._state = self.IDLE
+        self._backoff = 1
+        self._max_backoff = max_backoff
+        self._timeout = None  # 等待重连的定时器
+
+    @property
+    def state(self):
+        return self._state
 
     def connect(self):
         logger.info('Connecting to RabbitMQ')
+        self._state = self.CONNECTING
         return pika.TornadoConnection(pika.ConnectionParameters(host='192.168.2.194'), self.on_connection_open,
-                                      stop_ioloop_on_close=False)
+                                      on_open_error_callback=self.on_connection_open_error,
+                                      stop_ioloop_on_close=False, custom_ioloop=self._ioloop)
+
+    def on_connection_open_error(self, unused_connection, error_message=None):
+        """连接失败，等待后重连"""
+        logger.warning('Connect %s failed: %s', self._exchange_id, error_message)
+        self.schedule_reconnect()
 
     def on_connection_open(self, unused_connection):
         """This method is called by pika once the connection to RabbitMQ has
@@ -38,6 +70,10 @@ class TickConsumer(object):
         """
         logger.info('Connection opened')
         self.add_on_connection_close_callback()
+        if self._closing:
+            # 连接建立之前已经退订
+            self.close_connection()
+            return
         self.open_channel()
 
     def add_on_connection_close_callback(self):
@@ -59,28 +95,32 @@ class TickConsumer(object):
 
         """
         self._channel = None
+        self._consumer_tag = None
         if self._closing:
-            self._connection.ioloop.stop()
+            self._state = self.STOPPED
         else:
-            logger.warning('Connection closed, reopening in 5 seconds: (%s) %s',
-                            reply_code, reply_text)
-            self._connection.add_timeout(5, self.reconnect)
+            logger.warning('Connection closed: (%s) %s', reply_code, reply_text)
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        """连接断开后只在这里安排重连，等待时间按次翻倍"""
+        if self._closing:
+            self._state = self.STOPPED
+            return
+        logger.info('Reconnect %s in %s seconds', self._exchange_id, self._backoff)
+        self._state = self.WAITING
+        self._timeout = self._ioloop.call_later(self._backoff, self.reconnect)
+        self._backoff = min(self._backoff * 2, self._max_backoff)
 
     def reconnect(self):
         """Will be invoked by the IOLoop timer if the connection is
         closed. See the on_connection_closed method.
 
         """
-        # This is the old connection IOLoop instance, stop its ioloop
-        self._connection.ioloop.stop()
-
+        self._timeout = None
         if not self._closing:
-            # Create a new connection
             self._connection = self.connect()
 
-            # There is now a new connection, needs a new ioloop to run
-            self._connection.ioloop.start()
-
     def open_channel(self):
         """Open a new channel with RabbitMQ by issuing the Channel.Open RPC
         command. When RabbitMQ responds that the channel is open, the
@@ -126,7 +166,11 @@ class TickConsumer(object):
         """
         logger.warning('Channel %i was closed: (%s) %s',
                         channel, reply_code, reply_text)
-        self._connection.close()
+        # 通道上的消费随通道一起结束，之后的stop()直接关闭连接
+        self._channel = None
+        self._consumer_tag = None
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
 
     def setup_exchange(self, exchange_name, exchange_type='fanout'):
         """Setup the exchange on RabbitMQ by invoking the Exchange.Declare RPC
@@ -196,9 +240,14 @@ class TickConsumer(object):
         will invoke when a message is fully received.
 
         """
+        if self._closing:
+            # 声明、绑定队列期间已经退订，stop()已关闭连接，不再开始消费
+            return
         logger.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume(self.on_message, queue=self._queue_name, no_ack=True)
+        self._state = self.CONSUMING
+        self._backoff = 1
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -235,11 +284,8 @@ class TickConsumer(object):
         :param str|unicode body: The message body
 
         """
-        logger.info('Received message # %s from %s: %s', basic_deliver.delivery_tag, self._exchange_id, body)
-        self.queue.put(body)
-
-    def get_message(self):
-        return self.queue.get()
+        logger.debug('Received message # %s from %s: %s', basic_deliver.delivery_tag, self._exchange_id, body)
+        self._on_message(body)
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
@@ -280,27 +326,213 @@ class TickConsumer(object):
         logger.info('Closing the channel')
         self._channel.close()
 
-    def run(self):
-        """Run the example consumer by connecting to RabbitMQ and then
-        starting the IOLoop to block and allow the SelectConnection to operate.
-
-        """
-        while self._active:
-            self._connection = self.connect()
-            self._connection.ioloop.start()
-
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
         logger.info('Closing connection')
         self._connection.close()
 
     def start(self):
-        self._active = True
-        self._thread.start()
+        self._ioloop = IOLoop.current()
+        self._closing = False
+        self._connection = self.connect()
 
     def stop(self):
-        self._active = False
+        """停止消费并关闭连接，不会停止IOLoop"""
         self._closing = True
-        self.stop_consuming()
-        self._connection.ioloop.stop()
-        self._connection.close()
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self._state in (self.IDLE, self.WAITING, self.STOPPED):
+            self._state = self.STOPPED
+            return
+        self._state = self.CLOSING
+        if self._channel is not None and self._consumer_tag is not None:
+            # 正在消费，取消后由on_cancelok关闭通道和连接
+            self.stop_consuming()
+        elif self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
+            self.close_connection()
+
+
+class Tick(object):
+    """一条行情，SSE帧和解析结果只生成一次，所有订阅者共用"""
+
+    __slots__ = ('symbol', 'body', 'frame', '_event_frame', '_data')
+
+    def __init__(self, symbol, body):
+        self.symbol = symbol
+        self.body = body  # RabbitMQ消息原文，JSON字符串
+        self.frame = '{}\n\n'.format(body)  # 直接写给SSE客户端的数据
+        self._event_frame = None
+        self._data = None
+
+    @property
+    def event_frame(self):
+        """带合约名作为SSE event的数据，多合约订阅使用"""
+        if self._event_frame is None:
+            self._event_frame = 'event: {}\ndata: {}\n\n'.format(self.symbol, self.body)
+        return self._event_frame
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(self.body)
+        return self._data
+
+
+class TickFeed(object):
+    """
+    进程内共享的行情订阅，只在IOLoop线程中使用
+
+    同一(日期, 合约)只建一个TickConsumer，按订阅者引用计数，最后一个订阅者退订时断开。
+    每条行情只格式化一次，同一个Tick对象交给所有订阅者。每个合约的最新行情保留在内存中，
+    新订阅者立即收到，退订后仍可查询，日期变化后丢弃。
+    """
+
+    def __init__(self):
+        self.consumers = {}  # (date, symbol) -> TickConsumer
+        self.callbacks = {}  # (date, symbol) -> set(callback)
+        self.ticks = {}  # (date, symbol) -> 最新的Tick
+        self.buffers = set()  # 各客户端的TickBuffer，用于统计
+
+    def subscribe(self, symbol, callback, date=None):
+        """
+        :param symbol: 合约
+        :param callback: callback(Tick)，IOLoop中执行
+        :param date: YYYYMMDD，缺省为当天
+        :return: 订阅的日期，退订时传入同一日期（跨零点时缺省日期会变）
+        """
+        today = datetime.now().strftime('%Y%m%d')
+        key = (date or today, symbol)
+        self.callbacks.setdefault(key, set()).add(callback)
+        if key not in self.consumers:
+            self.prune(today)
+            consumer = TickConsumer('{}-{}'.format(*key), str(uuid.uuid4()), lambda body: self.dispatch(key, body))
+            self.consumers[key] = consumer
+            consumer.start()
+            logger.info('start tick consumer %s-%s', *key)
+        tick = self.ticks.get(key)
+        if tick is not None:
+            # 先推送最新行情，不用等下一笔
+            callback(tick)
+        return key[0]
+
+    def unsubscribe(self, symbol, callback, date=None):
+        key = (date or datetime.now().strftime('%Y%m%d'), symbol)
+        callbacks = self.callbacks.get(key)
+        if callbacks is None:
+            return
+        callbacks.discard(callback)
+        if not callbacks:
+            del self.callbacks[key]
+            consumer = self.consumers.pop(key)
+            consumer.stop()
+            logger.info('stop tick consumer %s-%s', *key)
+
+    def subscribers(self, symbol, date=None):
+        key = (date or datetime.now().strftime('%Y%m%d'), symbol)
+        return len(self.callbacks.get(key, ()))
+
+    def last(self, symbol, date=None):
+        """
+        :return: 合约最新的Tick，没有收到过时返回None
+        """
+        return self.ticks.get((date or datetime.now().strftime('%Y%m%d'), symbol))
+
+    def prune(self, today):
+        """丢弃已经没有订阅者的往日行情"""
+        for key in [key for key in self.ticks if key[0] < today and key not in self.consumers]:
+            del self.ticks[key]
+
+    def dispatch(self, key, body):
+        tick = self.ticks[key] = Tick(key[1], body)
+        for callback in list(self.callbacks.get(key, ())):
+            try:
+                callback(tick)
+            except Exception as exp:
+                logger.error('tick callback failed: %s', exp)
+
+    def metrics(self):
+        return {
+            'consumers': len(self.consumers),
+            'cached': len(self.ticks),
+            'clients': [buf.metrics() for buf in self.buffers],
+        }
+
+
+class TickBuffer(object):
+    """
+    一个SSE客户端的行情缓冲，只在IOLoop线程中使用
+
+    未发出的行情不超过high_water字节时按顺序全部保留；超过后同一合约只保留最新的一条，
+    被替换的行情计入conflated。客户端再慢，缓冲也不超过high_water加每个合约一条行情。
+    """
+
+    def __init__(self, feed, symbols, date=None, high_water=64 * 1024, name=None):
+        self.feed = feed
+        self.symbols = symbols
+        self.date = date
+        self.high_water = high_water  # 开始合并行情的积压字节数
+        self.name = name  # 客户端标识，统计中使用
+        self.pending = []  # 未发出的Tick
+        self.latest = {}  # symbol -> 该合约最新一条在pending中的位置
+        self.pending_bytes = 0
+        self.ready = Event()
+        self.sent = 0  # 已发出的行情数
+        self.conflated = 0  # 被合并丢弃的行情数
+        self.opened = False
+
+    def open(self):
+        for symbol in self.symbols:
+            self.feed.subscribe(symbol, self.put, self.date)
+        self.feed.buffers.add(self)
+        self.opened = True
+
+    def close(self):
+        if not self.opened:
+            return
+        self.opened = False
+        for symbol in self.symbols:
+            self.feed.unsubscribe(symbol, self.put, self.date)
+        self.feed.buffers.discard(self)
+        self.ready.set()
+
+    def put(self, tick):
+        index = self.latest.get(tick.symbol)
+        if index is not None and self.pending_bytes >= self.high_water:
+            # 积压过多，替换同一合约还没发出的那一条
+            self.pending_bytes += len(tick.body) - len(self.pending[index].body)
+            self.pending[index] = tick
+            self.conflated += 1
+        else:
+            self.latest[tick.symbol] = len(self.pending)
+            self.pending.append(tick)
+            self.pending_bytes += len(tick.body)
+        self.ready.set()
+
+    @gen.coroutine
+    def get(self):
+        """
+        :return: 积压的全部Tick，缓冲关闭后返回空列表
+        """
+        while not self.pending and self.opened:
+            self.ready.clear()
+            yield self.ready.wait()
+        if not self.opened:
+            raise gen.Return([])
+        ticks, self.pending = self.pending, []
+        self.latest.clear()
+        self.pending_bytes = 0
+        self.sent += len(ticks)
+        raise gen.Return(ticks)
+
+    def metrics(self):
+        return {
+            'name': self.name,
+            'symbols': len(self.symbols),
+            'sent': self.sent,
+            'conflated': self.conflated,
+            'pending_bytes': self.pending_bytes,
+        }
+
+
+tick_feed = TickFeed()
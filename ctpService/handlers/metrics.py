@@ -0,0 +1,25 @@
+# -*- coding:utf-8 -*-
+
+import json
+
+from tornado import web
+
+from gateway.session import session_manager
+from handlers.consumer import tick_feed
+
+
+class MetricsHandler(web.RequestHandler):
+    """各交易会话请求调度器的队列深度、等待时间等指标，以及行情推送的合并统计"""
+
+    def get(self, *args, **kwargs):
+        sessions = []
+        for (broker_id, user_id, address), session in session_manager.sessions.items():
+            sessions.append({
+                'broker_id': broker_id,
+                'user_id': user_id,
+                'address': address,
+                'refs': session.refs,
+                'lanes': session.trader.scheduler.metrics(),
+            })
+        self.set_header('content-type', 'application/json')
+        self.write(json.dumps({'sessions': sessions, 'ticks': tick_feed.metrics()}))
@@ -8,14 +8,43 @@ import redis
 from tornado import escape
 from tornado import web, gen
 from tornado.iostream import StreamClosedError
+from tornado.queues import Queue
 
 from gateway.constant import *
-from gateway.trader import NewTrader
+from gateway.order_book import TaggedQueue
+from gateway.registry import CtpError
+from gateway.session import session_manager, SessionError
 from logger import logger
 from settings import ORDER_QUEUE_KEY, TRADE_QUEUE_KEY
 
 client = redis.Redis(host='localhost', port=6379)
 
+MAX_BATCH_ORDERS = 500  # 批量报单单次最多笔数
+
+
+def parse_order(item):
+    """
+    校验并解析一笔报单参数
+    :param item: dict
+    :return: (symbol, price, volume, price_type, order_type, trade_date)
+    :raise ValueError: 参数错误
+    """
+    try:
+        symbol = str(item['symbol'])
+        price = float(item['price'])
+        volume = int(item['volume'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(u'symbol, price and volume are required.')
+    price_type = str(item.get('price_type'))
+    order_type = str(item.get('order_type'))
+    if volume <= 0:
+        raise ValueError(u'volume should be positive.')
+    if price_type not in PriceType.accept_type:
+        raise ValueError(u'price_type should be [limit|market]')
+    if order_type not in OrderType.accept_type:
+        raise ValueError(u'order_type should be [buy|sell|short|cover].')
+    return symbol, price, volume, price_type, order_type, item.get('trade_date', '')
+
 
 class SendOrderHandler(web.RequestHandler):
 
@@ -25,12 +54,14 @@ class SendOrderHandler(web.RequestHandler):
         self.set_header('Connection', 'keep-alive')
         self.body = escape.json_decode(self.request.body)
 
-        user_id = str(self.body.get('user_id'))
-        password = str(self.body.get('password'))
-        broker_id = str(self.body.get('broker_id', '9999'))
-        address = str(self.body.get('address', 'tcp://180.168.146.187:10003'))
-        self.trader = NewTrader(user_id, password, broker_id, address)
-        self.trader.start()
+        self.user_id = str(self.body.get('user_id'))
+        self.password = str(self.body.get('password'))
+        self.broker_id = str(self.body.get('broker_id', '9999'))
+        self.address = str(self.body.get('address', 'tcp://180.168.146.187:10003'))
+        self.trader = None
+        self.order_ref = None
+        self.order_key = None
+        self.queue = None
         # self.db_conn = pymysql.connect(
         #     host=db_config['host'], user=db_config['user'],
         #     password=db_config['passwd'], db=db_config['db'],
@@ -52,57 +83,77 @@ class SendOrderHandler(web.RequestHandler):
             msg = {'code': 4000, 'msg': u'price_type should be [limit|market]'}
             self.write(json.dumps(msg))
             self.finish()
+            return
 
         if order_type not in OrderType.accept_type:
             # 检查可接受的订单类型
             msg = {'code': 4000, 'msg': u'order_type should be [buy|sell|short|cover].'}
             self.write(json.dumps(msg))
             self.finish()
+            return
 
         try:
-            yield gen.sleep(0.1)
-            self.trader.send_order(symbol, price, volume, price_type, order_type, trade_date=trade_date)
+            self.trader = yield session_manager.acquire(self.user_id, self.password, self.broker_id, self.address)
+        except SessionError as exp:
+            self.write(json.dumps({'code': 4001, 'msg': str(exp)}))
+            self.finish()
+            return
+
+        try:
+            self.queue = Queue()
+            trader = self.trader
+            try:
+                self.order_ref = yield trader.send_order(symbol, price, volume, price_type, order_type,
+                                                         trade_date=trade_date, watcher=self.queue)
+            except CtpError as exp:
+                if not self._finished:
+                    self.write(json.dumps(exp.to_dict()))
+                    self.finish()
+                return
+
+            self.order_key = trader.order_key(self.order_ref)
+            if self.trader is None:
+                # 发单期间连接已关闭，会话已归还，按报单的键取消关注
+                trader.unwatch_order(self.order_key, self.queue)
+                return
             while not self._finished:
-                result = self.trader.get_order_message()
+                result = yield self.queue.get()
                 if result is None:
-                    logger.info('order queue is empty!')
-                    yield gen.sleep(0.01)
-                    continue
+                    # 连接已关闭
+                    break
 
-                result = json.loads(result)
-                if result.get('msg_type') == 'onErrRtnOrderInsert':
-                    logger.info('callback onErrRtnOrderInsert: %s', result['data'])
+                event = result
+                if event.msg_type == 'onErrRtnOrderInsert':
+                    logger.info('callback onErrRtnOrderInsert: %s', event.data)
                     # 报单失败
-                    self.write('{}\n\n'.format(json.dumps(result['data'])))
+                    self.write('{}\n\n'.format(event.to_json()))
                     self.finish()
-                elif result.get('msg_type') == 'onRspOrderInsert':
+                elif event.msg_type == 'onRspOrderInsert':
                     # 报单发生错误
-                    logger.info('callback onRspOrderInsert: %s', result['data'])
-                    self.write(json.dumps(result['data']))
+                    logger.info('callback onRspOrderInsert: %s', event.data)
+                    self.write(event.to_json())
                     self.finish()
-                elif result.get('msg_type') == 'onRtnOrder':
-                    logger.info('callback onRtnOrder: %s', result['data'])
-                    if result['data'].get('OrderStatus') == '5':
+                elif event.msg_type == 'onRtnOrder':
+                    logger.info('callback onRtnOrder: %s', event.data)
+                    # 报单状态更新，插入缓冲队列
+                    client.lpush(ORDER_QUEUE_KEY, event.to_json())
+                    if event.status == OrderStatus.CANCELED:
                         # 报单被撤销
-                        self.write('{}\n\n'.format(json.dumps(result['data'])))
+                        self.write('{}\n\n'.format(event.to_json()))
                         self.finish()
-
-                    # 报单成功，插入缓冲队列
-                    client.lpush(ORDER_QUEUE_KEY, json.dumps(result['data']))
-                    yield self.publish(json.dumps(result['data']))
-                elif result.get('msg_type') == 'onRtnTrade':
-                    logger.info('callback onRtnTrade: %s', result['data'])
+                    else:
+                        yield self.publish(event.to_json())
+                elif event.msg_type == 'onRtnTrade':
+                    logger.info('callback onRtnTrade: %s', event.data)
                     # 报单成交，插入交易缓冲队列
-                    client.lpush(TRADE_QUEUE_KEY, json.dumps(result['data']))
-                    yield self.publish(json.dumps(result['data']))
+                    client.lpush(TRADE_QUEUE_KEY, event.to_json())
+                    yield self.publish(event.to_json())
         except Exception as exp:
             logger.error('catch exception %s', exp)
             logger.error('traceback: %s', traceback.print_exc())
             raise web.HTTPError(500)
         finally:
-            if self.trader.connecting:
-                self.trader.close()
-                logger.info('finally close trader connection!')
+            self.release_trader()
 
     @gen.coroutine
     def publish(self, message):
@@ -113,17 +164,160 @@ class SendOrderHandler(web.RequestHandler):
         except StreamClosedError:
             self._finished = True
 
+    def release_trader(self):
+        """归还会话，会话本身保持登录供其他请求复用"""
+        if self.trader is not None:
+            if self.queue is not None and self.order_key is not None:
+                # 报单还在发出时order_key未知，由post在发单返回后取消关注
+                self.trader.unwatch_order(self.order_key, self.queue)
+            session_manager.release(self.trader)
+            self.trader = None
+
+    def on_connection_close(self):
+        logger.info('>>>>>>>>>>>>>on_connection_close time: %s', time.time())
+        self._finished = True
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+        self.release_trader()
+
+    def on_finish(self):
+        logger.info('<<<<<<<<<<<<<on_finish time: %s', time.time())
+        self._finished = True
+        self.release_trader()
+
+
+class SendOrdersHandler(web.RequestHandler):
+    """批量报单，所有报单在同一个会话上连续发出，回报按报单在请求中的序号标记后合并推送"""
+
+    def initialize(self):
+        self.set_header('content-type', 'text/event-stream')
+        self.set_header('cache-control', 'no-cache')
+        self.set_header('Connection', 'keep-alive')
+        self.body = escape.json_decode(self.request.body)
+
+        self.user_id = str(self.body.get('user_id'))
+        self.password = str(self.body.get('password'))
+        self.broker_id = str(self.body.get('broker_id', '9999'))
+        self.address = str(self.body.get('address', 'tcp://180.168.146.187:10003'))
+        self.trader = None
+        self.queue = None
+        self.watched = []  # [(order_key, TaggedQueue)]
+
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        items = self.body.get('orders')
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_ORDERS:
+            msg = {'code': 4000, 'msg': u'orders should be a list of 1-{} orders.'.format(MAX_BATCH_ORDERS)}
+            self.write(json.dumps(msg))
+            self.finish()
+            return
+
+        # 先校验全部报单，有一笔不合法就整体拒绝
+        orders = []
+        for index, item in enumerate(items):
+            try:
+                orders.append(parse_order(item))
+            except ValueError as exp:
+                self.write(json.dumps({'code': 4000, 'index': index, 'msg': unicode(exp)}))
+                self.finish()
+                return
+
+        try:
+            self.trader = yield session_manager.acquire(self.user_id, self.password, self.broker_id, self.address)
+        except SessionError as exp:
+            self.write(json.dumps({'code': 4001, 'msg': str(exp)}))
+            self.finish()
+            return
+
+        try:
+            self.queue = Queue()
+            trader = self.trader
+            # 全部报单一次提交给调度器，连续发出
+            futures = []
+            for index, (symbol, price, volume, price_type, order_type, trade_date) in enumerate(orders):
+                watcher = TaggedQueue(self.queue, index)
+                futures.append((index, watcher, trader.send_order(symbol, price, volume, price_type, order_type,
+                                                                  trade_date=trade_date, watcher=watcher)))
+            pending = {}  # index -> order_key
+            for index, watcher, future in futures:
+                try:
+                    order_ref = yield future
+                except CtpError as exp:
+                    if not self._finished:
+                        self.emit(index, 'error', json.dumps(exp.to_dict()))
+                    continue
+                key = trader.order_key(order_ref)
+                if self.trader is None:
+                    # 发单期间连接已关闭，会话已归还，按报单的键取消关注
+                    trader.unwatch_order(key, watcher)
+                    continue
+                self.watched.append((key, watcher))
+                pending[index] = key
+            if self.trader is None:
+                return
+            yield self.publish()
+
+            # 报单簿的状态可能领先于队列，报单都结束后还要把队列中已有的回报推完
+            while (pending or self.queue.qsize()) and not self._finished:
+                result = yield self.queue.get()
+                if result is None:
+                    # 连接已关闭
+                    break
+
+                index, event = result
+                if event.msg_type == 'onRtnOrder':
+                    client.lpush(ORDER_QUEUE_KEY, event.to_json())
+                elif event.msg_type == 'onRtnTrade':
+                    client.lpush(TRADE_QUEUE_KEY, event.to_json())
+                self.emit(index, event.msg_type, event.to_json())
+                if index in pending and trader.order_book.get(pending[index]).settled:
+                    del pending[index]
+                if self.queue.empty():
+                    # 同一批到达的回报合并成一次flush
+                    yield self.publish()
+            if not self._finished:
+                self.finish()
+        except Exception as exp:
+            logger.error('catch exception %s', exp)
+            logger.error('traceback: %s', traceback.print_exc())
+            raise web.HTTPError(500)
+        finally:
+            self.release_trader()
+
+    def emit(self, index, msg_type, data):
+        """
+        写入一条带序号的回报，由publish统一flush
+        :param data: 已编码的JSON，直接拼入消息，不再重复编码
+        """
+        self.write('{{"index": {}, "msg_type": "{}", "data": {}}}\n\n'.format(index, msg_type, data))
+
+    @gen.coroutine
+    def publish(self):
+        """Pushes buffered data to client."""
+        try:
+            yield self.flush()
+        except StreamClosedError:
+            self._finished = True
+
+    def release_trader(self):
+        """归还会话，会话本身保持登录供其他请求复用"""
+        if self.trader is not None:
+            for key, watcher in self.watched:
+                self.trader.unwatch_order(key, watcher)
+            session_manager.release(self.trader)
+            self.trader = None
+
     def on_connection_close(self):
         logger.info('>>>>>>>>>>>>>on_connection_close time: %s', time.time())
         self._finished = True
-        if self.trader.connecting:
-            self.trader.close()
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+        self.release_trader()
 
     def on_finish(self):
         logger.info('<<<<<<<<<<<<<on_finish time: %s', time.time())
         self._finished = True
-        if self.trader.connecting:
-            self.trader.close()
+        self.release_trader()
 
 
 class CalcelOrderHandler(web.RequestHandler):
@@ -134,13 +328,15 @@ class CalcelOrderHandler(web.RequestHandler):
         self.set_header('Connection', 'keep-alive')
         self.body = escape.json_decode(self.request.body)
 
-        user_id = str(self.body.get('user_id'))
-        password = str(self.body.get('password'))
-        broker_id = str(self.body.get('broker_id', '9999'))
-        address = str(self.body.get('address', 'tcp://180.168.146.187:10003'))
-        self.trader = NewTrader(user_id, password, broker_id, address)
-        self.trader.start()
+        self.user_id = str(self.body.get('user_id'))
+        self.password = str(self.body.get('password'))
+        self.broker_id = str(self.body.get('broker_id', '9999'))
+        self.address = str(self.body.get('address', 'tcp://180.168.146.187:10003'))
+        self.trader = None
+        self.order_key = None
+        self.queue = None
 
+    @gen.coroutine
     def post(self, *args, **kwargs):
         symbol = self.body.get('symbol')
         exchange_id = self.body.get('exchange')
@@ -155,38 +351,224 @@ class CalcelOrderHandler(web.RequestHandler):
             resp = {'code': 4000, 'msg': 'Params error!'}
             self.write(json.dumps(resp))
             self.finish()
+            return
 
         try:
-            yield gen.sleep(0.1)
-            self.trader.cancel_order(investor_id, broker_id, front_id, session_id, exchange_id, symbol, order_id)
+            self.trader = yield session_manager.acquire(self.user_id, self.password, self.broker_id, self.address)
+        except SessionError as exp:
+            self.write(json.dumps({'code': 4001, 'msg': str(exp)}))
+            self.finish()
+            return
+
+        self.order_key = self.trader.order_key(order_id, front_id, session_id)
+        self.queue = self.trader.watch_order(self.order_key)
+        try:
+            try:
+                yield self.trader.cancel_order(investor_id, broker_id, front_id, session_id, exchange_id, symbol,
+                                               order_id)
+            except CtpError as exp:
+                self.write(json.dumps(exp.to_dict()))
+                self.finish()
+                return
+
             while not self._finished:
-                result = self.trader.get_order_message()
+                result = yield self.queue.get()
                 if result is None:
-                    yield gen.sleep(0.01)
-                    continue
+                    # 连接已关闭
+                    break
 
-                data = json.loads(result)
-                if data.get('callback') == 'onErrRtnOrderAction':
-                    self.write(json.dumps(data))
+                event = result
+                if event.msg_type in ('onErrRtnOrderAction', 'onRspOrderAction'):
+                    self.write(event.to_json())
                     self.finish()
-                if data.get('callback') == 'onRspOrderAction':
-                    self.write(json.dumps(data))
+                elif event.msg_type == 'onRtnOrder' and event.status == OrderStatus.CANCELED:
+                    # 撤单成功
+                    self.write(event.to_json())
                     self.finish()
         except Exception as exp:
             logger.error('catch exception %s', exp)
             logger.error('traceback: %s.', traceback.print_exc())
         finally:
-            if self.trader.connecting:
-                self.trader.close()
+            self.release_trader()
+
+    def release_trader(self):
+        """归还会话，会话本身保持登录供其他请求复用"""
+        if self.trader is not None:
+            if self.queue is not None:
+                self.trader.unwatch_order(self.order_key, self.queue)
+            session_manager.release(self.trader)
+            self.trader = None
+
+    def on_connection_close(self):
+        logger.info('>>>>>>>>>> into on_connection_close!')
+        self._finished = True
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+        self.release_trader()
+
+    def on_finish(self):
+        logger.info('<<<<<<<<<< into on_finish!')
+        self._finished = True
+        self.release_trader()
+
+
+class CancelOrdersHandler(web.RequestHandler):
+    """
+    批量撤单，按报单编号列表、合约或整个账户撤销未结束的报单
+
+    待撤报单从会话的报单簿中查出，撤单请求在同一个会话上连续发出，回报合并推送。
+    """
+
+    def initialize(self):
+        self.set_header('content-type', 'text/event-stream')
+        self.set_header('cache-control', 'no-cache')
+        self.set_header('Connection', 'keep-alive')
+        self.body = escape.json_decode(self.request.body)
+
+        self.user_id = str(self.body.get('user_id'))
+        self.password = str(self.body.get('password'))
+        self.broker_id = str(self.body.get('broker_id', '9999'))
+        self.address = str(self.body.get('address', 'tcp://180.168.146.187:10003'))
+        self.trader = None
+        self.queue = None
+        self.watched = []  # [(order_key, TaggedQueue)]
+
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        order_ids = self.body.get('order_ids')
+        symbol = self.body.get('symbol')
+        cancel_all = self.body.get('all')
+        if order_ids is None and symbol is None and not cancel_all:
+            resp = {'code': 4000, 'msg': 'one of order_ids, symbol or all is required.'}
+            self.write(json.dumps(resp))
+            self.finish()
+            return
+        if order_ids is not None and not isinstance(order_ids, list):
+            resp = {'code': 4000, 'msg': 'order_ids should be a list.'}
+            self.write(json.dumps(resp))
+            self.finish()
+            return
+
+        try:
+            self.trader = yield session_manager.acquire(self.user_id, self.password, self.broker_id, self.address)
+        except SessionError as exp:
+            self.write(json.dumps({'code': 4001, 'msg': str(exp)}))
+            self.finish()
+            return
+
+        try:
+            self.queue = Queue()
+            result = {'total': 0, 'canceled': 0, 'failed': 0}
+            pending = {}  # order_key -> Order
+            futures = []
+            for order in self.resolve(order_ids, symbol):
+                result['total'] += 1
+                watcher = TaggedQueue(self.queue, order.key)
+                self.trader.watch_order(order.key, watcher)
+                self.watched.append((order.key, watcher))
+                pending[order.key] = order
+                futures.append((order, self.trader.cancel_book_order(order)))
+            for order, future in futures:
+                try:
+                    yield future
+                except CtpError as exp:
+                    self.emit(order.key, 'error', json.dumps(exp.to_dict()))
+                    if pending.pop(order.key, None) is not None:
+                        result['failed'] += 1
+            yield self.publish()
+
+            while (pending or self.queue.qsize()) and not self._finished:
+                item = yield self.queue.get()
+                if item is None:
+                    # 连接已关闭
+                    break
+
+                key, event = item
+                if event.msg_type == 'onRtnOrder':
+                    client.lpush(ORDER_QUEUE_KEY, event.to_json())
+                elif event.msg_type == 'onRtnTrade':
+                    client.lpush(TRADE_QUEUE_KEY, event.to_json())
+                self.emit(key, event.msg_type, event.to_json())
+                if key in pending:
+                    if event.msg_type in ('onErrRtnOrderAction', 'onRspOrderAction'):
+                        result['failed'] += 1
+                        del pending[key]
+                    elif not pending[key].active:
+                        if pending[key].status == OrderStatus.CANCELED:
+                            result['canceled'] += 1
+                        else:
+                            # 撤单前已全部成交等
+                            result['failed'] += 1
+                        del pending[key]
+                if self.queue.empty():
+                    yield self.publish()
+            if not self._finished:
+                self.emit(None, 'done', json.dumps(result))
+                self.finish()
+        except Exception as exp:
+            logger.error('catch exception %s', exp)
+            logger.error('traceback: %s', traceback.print_exc())
+            raise web.HTTPError(500)
+        finally:
+            self.release_trader()
+
+    def resolve(self, order_ids, symbol):
+        """
+        从报单簿中查出待撤的未结束报单
+        :param order_ids: OrderRef列表（本会话），或{'order_id', 'front_id', 'session_id'}列表
+        :param symbol: 合约代码，与order_ids都为空时撤销全部报单
+        :return: [Order]
+        """
+        if order_ids is None:
+            return self.trader.order_book.working(symbol)
+
+        orders = []
+        for item in order_ids:
+            if isinstance(item, dict):
+                key = self.trader.order_key(item.get('order_id'), item.get('front_id'), item.get('session_id'))
+            else:
+                key = self.trader.order_key(item)
+            order = self.trader.order_book.get(key)
+            if order is not None and order.active and (symbol is None or order.symbol == symbol):
+                orders.append(order)
+        return orders
+
+    def emit(self, key, msg_type, data):
+        """
+        写入一条带报单编号的回报，由publish统一flush
+        :param data: 已编码的JSON，直接拼入消息，不再重复编码
+        """
+        if key is None:
+            self.write('{{"msg_type": "{}", "data": {}}}\n\n'.format(msg_type, data))
+        else:
+            front_id, session_id, order_ref = key
+            self.write('{{"front_id": {}, "session_id": {}, "order_id": {}, "msg_type": "{}", "data": {}}}\n\n'.format(
+                front_id, session_id, json.dumps(order_ref), msg_type, data))
+
+    @gen.coroutine
+    def publish(self):
+        """Pushes buffered data to client."""
+        try:
+            yield self.flush()
+        except StreamClosedError:
+            self._finished = True
+
+    def release_trader(self):
+        """归还会话，会话本身保持登录供其他请求复用"""
+        if self.trader is not None:
+            for key, watcher in self.watched:
+                self.trader.unwatch_order(key, watcher)
+            session_manager.release(self.trader)
+            self.trader = None
 
     def on_connection_close(self):
         logger.info('>>>>>>>>>> into on_connection_close!')
         self._finished = True
-        if self.trader.connecting:
-            self.trader.close()
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+        self.release_trader()
 
     def on_finish(self):
         logger.info('<<<<<<<<<< into on_finish!')
         self._finished = True
-        if self.trader.connecting:
-            self.trader.close()
+        self.release_trader()
@@ -1,12 +1,13 @@
 # -*- coding:utf-8 -*-
 
 import json
-from Queue import Empty
+from datetime import timedelta
 
 from tornado import web, gen
 from tornado.iostream import StreamClosedError
+from tornado.options import options
 
-from gateway.trader import NewTrader
+from gateway.session import session_manager, SessionError
 from logger import logger
 
 
@@ -16,34 +17,43 @@ class PositionHandler(web.RequestHandler):
         self.set_header('content-type', 'text/event-stream')
         self.set_header('cache-control', 'no-cache')
         self.set_header('Connection', 'keep-alive')
-        user_id = str(self.get_argument('user_id'))
-        password = str(self.get_argument('password'))
-        broker_id = str(self.get_argument('broker_id', '9999'))
-        address = str(self.get_argument('address', 'tcp://180.168.146.187:10003'))
-        logger.info('address: %s', address)
-        self.trader = NewTrader(user_id, password, broker_id, address)
-        self.trader.start()
+        self.user_id = str(self.get_argument('user_id'))
+        self.password = str(self.get_argument('password'))
+        self.broker_id = str(self.get_argument('broker_id', '9999'))
+        self.address = str(self.get_argument('address', 'tcp://180.168.146.187:10003'))
+        logger.info('address: %s', self.address)
+        self.trader = None
+        self.queue = None
+        self.seq = 0  # 最近推送的消息序号，心跳中带上
 
     @gen.coroutine
     def get(self, *args, **kwargs):
         try:
+            self.trader = yield session_manager.acquire(self.user_id, self.password, self.broker_id, self.address)
+        except SessionError as exp:
+            self.write(json.dumps({'code': 4001, 'msg': str(exp)}))
+            self.finish()
+            return
+
+        try:
+            self.queue = self.trader.positions.subscribe()
             while not self._finished:
-                yield gen.sleep(1)
-                self.trader.query_position()
                 try:
-                    msg = self.trader.get_position()
-                    msg = json.loads(msg)
-                    position = json.dumps(msg['data'])
-                    yield self.publish(position)
-                except Empty:
+                    event = yield self.queue.get(timeout=timedelta(seconds=options.heartbeat))
+                except gen.TimeoutError:
+                    # 持仓没有变化
+                    yield self.publish(json.dumps({'msg_type': 'heartbeat', 'seq': self.seq}))
                     continue
+                if event is None:
+                    # 连接已关闭
+                    break
+                self.seq = event.seq
+                yield self.publish(event.to_json())
         except Exception as exp:
             logger.error('catch exception {}.'.format(exp))
             raise web.HTTPError(500)
         finally:
-            if self.trader.connecting:
-                self.trader.close()
-                logger.info('finally close trader connection!')
+            self.release_trader()
 
     @gen.coroutine
     def publish(self, message):
@@ -54,14 +64,22 @@ class PositionHandler(web.RequestHandler):
         except StreamClosedError:
             self._finished = True
 
+    def release_trader(self):
+        """归还会话，会话本身保持登录供其他请求复用"""
+        if self.trader is not None:
+            if self.queue is not None:
+                self.trader.positions.unsubscribe(self.queue)
+            session_manager.release(self.trader)
+            self.trader = None
+
     def on_connection_close(self):
         logger.info('>>>>>>>>>>>>>into on_connection_close')
         self._finished = True
-        if self.trader.connecting:
-            self.trader.close()
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+        self.release_trader()
 
     def on_finish(self):
         logger.info('>>>>>>>>>>>>>into on_finish')
         self._finished = True
-        if self.trader.connecting:
-            self.trader.close()
+        self.release_trader()
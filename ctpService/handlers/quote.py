@@ -0,0 +1,33 @@
+# -*- coding:utf-8 -*-
+
+import json
+from datetime import datetime
+
+from tornado import web
+
+from consumer import tick_feed
+from subscribe import MAX_SYMBOLS, resolve_symbols
+
+
+class QuoteHandler(web.RequestHandler):
+    """
+    批量查询最新行情，symbols=rb1901,zn1901,ru*，只读内存中的最新行情，不访问行情服务器；
+    没有收到过行情的合约返回null
+    """
+
+    def get(self, *args, **kwargs):
+        items = [item.strip() for item in self.get_argument('symbols', '').split(',') if item.strip()]
+        date_str = self.get_argument('date', datetime.now().strftime('%Y%m%d'))
+        symbols = resolve_symbols(items)
+        if not 0 < len(symbols) <= MAX_SYMBOLS:
+            msg = {'code': 4000, 'msg': u'symbols should match 1-{} instruments.'.format(MAX_SYMBOLS)}
+            self.write(json.dumps(msg))
+            return
+
+        # 行情原文已是JSON，直接拼接，不再解码和编码
+        parts = []
+        for symbol in symbols:
+            tick = tick_feed.last(symbol, date_str)
+            parts.append('{}: {}'.format(json.dumps(symbol), tick.body if tick is not None else 'null'))
+        self.set_header('content-type', 'application/json')
+        self.write('{{{}}}'.format(', '.join(parts)))
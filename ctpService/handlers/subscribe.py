@@ -1,54 +1,113 @@
 # -*- coding:utf-8 -*-
 
-import uuid
+import json
 from datetime import datetime
 
 from tornado import web, gen
 from tornado.iostream import StreamClosedError
 
-from consumer import TickConsumer
+from consumer import TickBuffer, tick_feed
+from gateway.instrument import instrument_registry
 from logger import logger
 
+MAX_SYMBOLS = 200  # 一个连接最多订阅的合约数
+
+
+def resolve_symbols(items):
+    """
+    展开订阅参数，'rb*'表示品种rb的全部合约
+    :param items: 合约或品种通配的列表
+    :return: 去重后的合约列表，保持参数顺序
+    """
+    symbols = []
+    for item in items:
+        if item.endswith('*'):
+            symbols.extend(instrument_registry.product_symbols(item[:-1]))
+        else:
+            symbols.append(item)
+    seen = set()
+    return [symbol for symbol in symbols if not (symbol in seen or seen.add(symbol))]
+
 
 class SubscribeHandler(web.RequestHandler):
+    """
+    行情推送，symbol=rb1901 订阅一个合约；symbols=rb1901,zn1901,ru* 在一个连接中订阅多个合约，
+    每条行情以合约代码作为SSE的event名
+
+    客户端读得慢时同一合约只推送最新的行情，被合并的条数以conflated事件告知客户端
+    """
 
     def initialize(self):
         self.set_header('content-type', 'text/event-stream')
         self.set_header('cache-control', 'no-cache')
         self.set_header('Connection', 'keep-alive')
-        symbol = self.get_argument('symbol')
-        date_str = self.get_argument('date', datetime.now().strftime('%Y%m%d'))
-        exchange_id = '{}-{}'.format(date_str, symbol)
-        queue_name = str(uuid.uuid4())
-        self.consumer = TickConsumer(exchange_id, queue_name)
-        self.consumer.start()
+        self.symbol = self.get_argument('symbol', None)
+        self.symbols = [item.strip() for item in self.get_argument('symbols', '').split(',') if item.strip()]
+        self.date_str = self.get_argument('date', datetime.now().strftime('%Y%m%d'))
+        self.buffer = None
 
     @gen.coroutine
     def get(self, *args, **kwargs):
+        if self.symbols:
+            symbols = resolve_symbols(self.symbols)
+            named = True
+        elif self.symbol:
+            symbols = [self.symbol]
+            named = False
+        else:
+            symbols = []
+            named = False
+        if not 0 < len(symbols) <= MAX_SYMBOLS:
+            msg = {'code': 4000, 'msg': u'symbols should match 1-{} instruments.'.format(MAX_SYMBOLS)}
+            self.write(json.dumps(msg))
+            self.finish()
+            return
+
+        # 同一合约的所有客户端共用一个行情连接
+        buf = self.buffer = TickBuffer(tick_feed, symbols, self.date_str, name=self.request.remote_ip)
+        buf.open()
+        conflated = 0
         try:
             while not self._finished:
-                message = yield self.consumer.get_message()
-                yield self.publish(message)
+                ticks = yield buf.get()
+                if not ticks:
+                    # 连接已关闭
+                    break
+                # 一次flush写出积压的行情，flush完成之前到达的行情在缓冲中合并
+                self.write(''.join(tick.event_frame if named else tick.frame for tick in ticks))
+                if buf.conflated != conflated:
+                    conflated = buf.conflated
+                    self.write('event: conflated\ndata: {}\n\n'.format(json.dumps({'conflated': conflated})))
+                yield self.publish()
         except Exception as exp:
             logger.error('catch exception {}.'.format(exp))
             raise web.HTTPError(500)
         finally:
-            self.consumer.stop()
-            self.finish()
+            self.unsubscribe()
+            if not self._finished:
+                self.finish()
 
     @gen.coroutine
-    def publish(self, message):
+    def publish(self):
         """Pushes data to a listener."""
         try:
-            self.write('{}\n\n'.format(message))
             yield self.flush()
         except StreamClosedError:
             self._finished = True
 
+    def unsubscribe(self):
+        if self.buffer is not None:
+            if self.buffer.conflated:
+                logger.info('%s conflated %s of %s ticks', self.buffer.name, self.buffer.conflated,
+                            self.buffer.sent + self.buffer.conflated)
+            self.buffer.close()
+            self.buffer = None
+
     def on_connection_close(self):
         logger.info('>>>>>>>>>>>>>into on_connection_close')
-        self.consumer.stop()
+        self._finished = True
+        self.unsubscribe()
 
     def on_finish(self):
         logger.info('>>>>>>>>>>>>>into on_finish')
-        self.consumer.stop()
+        self.unsubscribe()
@@ -12,6 +12,11 @@ from logger import logger
 define('port', 10080, help="run on the given port", type=int)
 define("debug", default=False, help="debug mode")
 define("config", default=None, help="tornado config file")
+define('topic_mode', default='resume', help="CTP private/public topic mode [restart|resume|quick]")
+define('estimate_interval', default=1, type=float, help="seconds between account estimate pushes")
+define('account_query_interval', default=30, type=float, help="seconds between real account queries")
+define('commission_rate', default=0.0001, type=float, help="commission per turnover used by account estimate")
+define('heartbeat', default=15, type=int, help="seconds between SSE heartbeats when account/position is unchanged")
 
 tornado.options.parse_command_line()
 
@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway.constant import Direction, Offset, PosiDirection, PositionDate
+from gateway.event import PositionEvent, TradeEvent
+from gateway.ledger import PositionLedger, merge_positions
+
+
+def position_row(date, position, today, cost, symbol='rb1901'):
+    return PositionEvent({
+        'InstrumentID': symbol, 'PosiDirection': PosiDirection.LONG, 'PositionDate': date,
+        'Position': position, 'TodayPosition': today, 'PositionCost': cost, 'PositionProfit': 0.0,
+    })
+
+
+def rtn_trade(trade_id, offset, volume, direction=Direction.SHORT):
+    return TradeEvent({
+        'TradeID': trade_id, 'InstrumentID': 'rb1901', 'ExchangeID': 'SHFE', 'OrderSysID': '1',
+        'Direction': direction, 'OffsetFlag': offset, 'Price': 4000.0, 'Volume': volume,
+    })
+
+
+class MergePositionsTest(unittest.TestCase):
+
+    def test_shfe_two_rows(self):
+        """上期所今昨仓分两条回报，合并为一行"""
+        positions = merge_positions([
+            position_row(PositionDate.HISTORY, 3, 0, 3000.0),
+            position_row(PositionDate.TODAY, 2, 2, 2000.0),
+        ])
+        self.assertEqual(list(positions), [('rb1901', PosiDirection.LONG)])
+        position = positions[('rb1901', PosiDirection.LONG)]
+        self.assertEqual((position.today, position.yd, position.position), (2, 3, 5))
+        self.assertEqual(position.cost, 5000.0)
+
+    def test_single_row(self):
+        """其他交易所一条回报，昨仓为总持仓减今仓"""
+        positions = merge_positions([position_row(PositionDate.TODAY, 5, 2, 5000.0, symbol='m1901')])
+        position = positions[('m1901', PosiDirection.LONG)]
+        self.assertEqual((position.today, position.yd), (2, 3))
+
+
+class PositionLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ledger = PositionLedger(query=None)
+        self.ledger.positions = merge_positions([
+            position_row(PositionDate.HISTORY, 3, 0, 3000.0),
+            position_row(PositionDate.TODAY, 2, 2, 2000.0),
+        ])
+        self.ledger.loaded = True
+        self.position = self.ledger.positions[('rb1901', PosiDirection.LONG)]
+
+    def test_close_yesterday_first(self):
+        """平仓先平昨仓再平今仓，成本按比例减少"""
+        self.ledger.on_trade(rtn_trade('t1', Offset.CLOSE, 4))
+        self.assertEqual((self.position.today, self.position.yd), (1, 0))
+        self.assertAlmostEqual(self.position.cost, 1000.0)
+
+    def test_close_today(self):
+        self.ledger.on_trade(rtn_trade('t1', Offset.CLOSE_TODAY, 1))
+        self.assertEqual((self.position.today, self.position.yd), (1, 3))
+
+    def test_open_and_replay(self):
+        """开仓增加今仓，重复的成交回报不重复计入"""
+        self.ledger.on_trade(rtn_trade('t1', Offset.OPEN, 1, direction=Direction.LONG))
+        self.ledger.on_trade(rtn_trade('t1', Offset.OPEN, 1, direction=Direction.LONG))
+        self.assertEqual((self.position.today, self.position.yd), (3, 3))
+        self.assertAlmostEqual(self.position.cost, 9000.0)
+
+    def test_new_trading_day(self):
+        """新交易日成交编号可能重复，不能当作回放丢弃"""
+        self.ledger.on_trade(rtn_trade('t1', Offset.CLOSE_TODAY, 1))
+        self.ledger.reset()
+        self.ledger.on_trade(rtn_trade('t1', Offset.CLOSE_TODAY, 1))
+        self.assertEqual((self.position.today, self.position.yd), (0, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway.constant import OrderStatus
+from gateway.event import ErrorEvent, OrderEvent, TradeEvent
+from gateway.order_book import OrderBook, order_key
+
+
+def rtn_order(status, sys_id='', traded=0, ref='1'):
+    return OrderEvent({
+        'FrontID': 1, 'SessionID': 100, 'OrderRef': ref, 'InstrumentID': 'rb1901', 'ExchangeID': 'SHFE',
+        'OrderSysID': sys_id, 'OrderStatus': status, 'VolumeTotalOriginal': 2, 'VolumeTraded': traded,
+    })
+
+
+def rtn_trade(trade_id, sys_id='  123', volume=1):
+    return TradeEvent({
+        'TradeID': trade_id, 'InstrumentID': 'rb1901', 'ExchangeID': 'SHFE', 'OrderSysID': sys_id, 'Volume': volume,
+    })
+
+
+class OrderBookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.book = OrderBook()
+        self.key = order_key(1, 100, '1')
+
+    def test_trade_before_sys_id(self):
+        """成交回报先于带OrderSysID的报单回报到达"""
+        queue = self.book.watch(self.key)
+        self.book.on_order(rtn_order(OrderStatus.UNKNOWN))
+        self.book.on_trade(rtn_trade('t1'))
+        order = self.book.get(self.key)
+        self.assertEqual(order.trades, [])
+        self.assertIn(('SHFE', '123'), self.book.pending_trades)
+
+        self.book.on_order(rtn_order(OrderStatus.PART_TRADED_QUEUEING, '  123', traded=1))
+        self.assertEqual([trade.trade_id for trade in order.trades], ['t1'])
+        self.assertEqual(self.book.pending_trades, {})
+        # 报单回报在前，暂存的成交随后转给关注的请求
+        events = [queue.get_nowait() for _ in range(queue.qsize())]
+        self.assertEqual([event.msg_type for event in events], ['onRtnOrder', 'onRtnOrder', 'onRtnTrade'])
+
+        # 重连回放的同一笔成交不重复计入
+        self.book.on_trade(rtn_trade('t1'))
+        self.assertEqual(len(order.trades), 1)
+
+    def test_stale_replay_keeps_finished(self):
+        """回放的旧回报不会把已结束的报单改回未结束"""
+        self.book.on_order(rtn_order(OrderStatus.NO_TRADE_QUEUEING, '123'))
+        self.book.on_order(rtn_order(OrderStatus.CANCELED, '123'))
+        queue = self.book.watch(self.key)
+
+        self.book.on_order(rtn_order(OrderStatus.NO_TRADE_QUEUEING, '123'))
+        order = self.book.get(self.key)
+        self.assertEqual(order.status, OrderStatus.CANCELED)
+        self.assertEqual(order.data.status, OrderStatus.CANCELED)
+        self.assertEqual(self.book.working(), [])
+        self.assertEqual(queue.qsize(), 0)
+
+    def test_watch_unknown_order(self):
+        """关注未知报单不会留下未结束的空报单，错误回报仍能收到"""
+        queue = self.book.watch(self.key)
+        self.assertEqual(self.book.working(), [])
+        self.book.on_error(self.key, ErrorEvent('onRspOrderAction', {
+            'OrderRef': '1', 'FrontID': 1, 'SessionID': 100, 'ErrorID': 26, 'ErrorMsg': 'not found',
+        }))
+        self.assertEqual(queue.get_nowait().msg_type, 'onRspOrderAction')
+        self.book.unwatch(self.key, queue)
+        self.assertEqual(self.book.watchers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import threading
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway.order_ref import OrderRefAllocator
+
+
+class FakeRedis(object):
+    """只实现INCRBY，租约可能在后台线程中执行"""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def incrby(self, key, amount):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            return self.values[key]
+
+
+class OrderRefAllocatorTest(AsyncTestCase):
+
+    @gen_test
+    def test_shared_counter(self):
+        """两个会话共用一个计数器，编号互不重复且各自单调递增"""
+        client = FakeRedis()
+        allocators = [OrderRefAllocator('9999', '126077', block=5, client=client) for _ in range(2)]
+        refs = [[], []]
+        for i in range(40):
+            index = i % 3 % 2
+            refs[index].append(int(allocators[index].allocate()))
+            if i % 4 == 0:
+                # 让后台预租的结果回到IOLoop
+                yield gen.sleep(0.01)
+
+        for values in refs:
+            self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(refs[0]) | set(refs[1])), 40)
+
+    @gen_test
+    def test_seed_above_max_order_ref(self):
+        """计数器落后于登录回报的MaxOrderRef时跳过去"""
+        client = FakeRedis()
+        first = OrderRefAllocator('9999', '126077', block=5, client=client)
+        self.assertEqual(first.allocate(), '1')
+
+        second = OrderRefAllocator('9999', '126077', block=5, client=client)
+        second.seed(100)
+        yield gen.sleep(0.01)
+        refs = [int(second.allocate()) for _ in range(12)]
+        self.assertGreater(refs[0], 100)
+        self.assertEqual(refs, sorted(set(refs)))
+        self.assertGreater(int(first.allocate()), 1)
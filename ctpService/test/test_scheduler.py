@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gateway.registry import CtpError
+from gateway.scheduler import Scheduler
+
+
+class SchedulerTest(AsyncTestCase):
+
+    @gen_test
+    def test_flow_control_requeued(self):
+        """-3被流控的请求放回队首，下一个令牌时先于后来的请求重发"""
+        scheduler = Scheduler(trade_rate=50, trade_burst=1)
+        calls = []
+
+        def insert():
+            calls.append('insert')
+            if calls.count('insert') == 1:
+                raise CtpError(-3, 'flow control')
+            return 'inserted'
+
+        def cancel():
+            calls.append('cancel')
+            return 'canceled'
+
+        first = scheduler.submit(Scheduler.TRADE, insert)
+        second = scheduler.submit(Scheduler.TRADE, cancel)
+        results = yield [first, second]
+        self.assertEqual(results, ['inserted', 'canceled'])
+        self.assertEqual(calls, ['insert', 'insert', 'cancel'])
+        metrics = scheduler.metrics()[Scheduler.TRADE]
+        self.assertEqual(metrics['retried'], 1)
+        self.assertEqual(metrics['sent'], 2)
+
+    @gen_test
+    def test_other_error_not_retried(self):
+        scheduler = Scheduler()
+
+        def insert():
+            raise CtpError(-1, 'network')
+
+        with self.assertRaises(CtpError):
+            yield scheduler.submit(Scheduler.TRADE, insert)
+        self.assertEqual(scheduler.metrics()[Scheduler.TRADE]['retried'], 0)
+
+    @gen_test
+    def test_query_waits_for_response(self):
+        """查询通道在上一个查询回报前不发下一个，相同key的查询共用结果"""
+        scheduler = Scheduler(query_rate=50)
+        responses = []
+
+        def query():
+            responses.append(Future())
+            return responses[-1]
+
+        first = scheduler.submit(Scheduler.QUERY, query, key='qryPosition')
+        same = scheduler.submit(Scheduler.QUERY, query, key='qryPosition')
+        other = scheduler.submit(Scheduler.QUERY, query, key='qryAccount')
+        self.assertIs(first, same)
+        yield gen.sleep(0.1)
+        self.assertEqual(len(responses), 1)
+
+        responses[0].set_result('position')
+        self.assertEqual((yield first), 'position')
+        yield gen.sleep(0.1)
+        self.assertEqual(len(responses), 2)
+        responses[1].set_result('account')
+        self.assertEqual((yield other), 'account')
+        self.assertEqual(scheduler.metrics()[Scheduler.QUERY]['deduped'], 1)
@@ -1,22 +1,65 @@
 # -*- coding:utf-8 -*-
 
+import argparse
+import time
+
 import redis
 
 client = redis.Redis(host='localhost', port=6379)
 order_id_key = 'UNIQUE_ORDER_ID'
+last_id_key = 'UNIQUE_ORDER_ID_LAST'  # 已生成的最大编号，补充时从这里继续
+
 
+def positive_int(value):
+    """argparse参数类型：正整数"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return number
 
-def gen_order_id(max_id):
-    for order in range(1, max_id):
+
+def gen_order_id(start, count):
+    for order in range(start, start + count):
         yield str(order)
 
 
-def push_to_memory(order_id):
-    print('add order_id {}'.format(order_id))
-    client.rpush(order_id_key, *[order_id])
+def push_to_memory(order_ids, chunk=1000):
+    """分块rpush，所有块在一个pipeline中一次往返写入"""
+    pipe = client.pipeline(transaction=False)
+    for i in range(0, len(order_ids), chunk):
+        pipe.rpush(order_id_key, *order_ids[i:i + chunk])
+    pipe.execute()
+    print('add order_id {} - {}'.format(order_ids[0], order_ids[-1]))
+
+
+def refill(count, chunk):
+    """从上次生成的最大编号之后补充count个，先用INCRBY占住编号段，多个进程同时补充也不会重复"""
+    start = client.incrby(last_id_key, count) - count + 1
+    push_to_memory(list(gen_order_id(start, count)), chunk)
+
+
+def run_daemon(low_water, count, chunk, interval):
+    """剩余编号少于low_water时自动补充"""
+    print('watch {}, refill {} when less than {}'.format(order_id_key, count, low_water))
+    while True:
+        try:
+            if client.llen(order_id_key) < low_water:
+                refill(count, chunk)
+        except redis.RedisError as exp:
+            print('refill failed: {}'.format(exp))
+        time.sleep(interval)
 
 
 if __name__ == '__main__':
-    order_gen = gen_order_id(10000)
-    for oid in order_gen:
-        push_to_memory(oid)
+    parser = argparse.ArgumentParser(description='seed {} in redis'.format(order_id_key))
+    parser.add_argument('--count', type=positive_int, default=10000, help='ids to add each time')
+    parser.add_argument('--chunk', type=positive_int, default=1000, help='ids per rpush')
+    parser.add_argument('--daemon', action='store_true', help='keep running and refill before the list drains')
+    parser.add_argument('--low-water', type=int, default=2000, help='refill when fewer ids are left')
+    parser.add_argument('--interval', type=float, default=1, help='seconds between checks in daemon mode')
+    args = parser.parse_args()
+
+    if args.daemon:
+        run_daemon(args.low_water, args.count, args.chunk, args.interval)
+    else:
+        refill(args.count, args.chunk)
@@ -5,8 +5,10 @@ from handlers.broker import BrokerHandler
 from handlers.hello import HelloHandler
 from handlers.history import OneMinuteBarHandler, ThirtyMinuteBarHandler, DailyBarHandler
 from handlers.instrument import InstrumentListHandler
-from handlers.order import SendOrderHandler, CalcelOrderHandler
+from handlers.metrics import MetricsHandler
+from handlers.order import SendOrderHandler, SendOrdersHandler, CalcelOrderHandler, CancelOrdersHandler
 from handlers.position import PositionHandler
+from handlers.quote import QuoteHandler
 from handlers.subscribe import SubscribeHandler
 from handlers.test import TestHandler
 
@@ -15,14 +17,18 @@ url_patterns = [
     (r'/hello', HelloHandler),
 
     (r'/v1/subscribe', SubscribeHandler),
+    (r'/v1/quotes', QuoteHandler),
     (r'/v1/account', AccountHandler),
     (r'/v1/position', PositionHandler),
     (r'/v1/send_order', SendOrderHandler),
+    (r'/v1/send_orders', SendOrdersHandler),
     (r'/v1/cancel_order', CalcelOrderHandler),
+    (r'/v1/cancel_orders', CancelOrdersHandler),
     (r'/v1/instrument_list', InstrumentListHandler),
     (r'/v1/history/one_minute', OneMinuteBarHandler),
     (r'/v1/history/thirty_minute', ThirtyMinuteBarHandler),
     (r'/v1/history/daily', DailyBarHandler),
+    (r'/v1/metrics', MetricsHandler),
 
     (r'/v1/broker', BrokerHandler),
 ]